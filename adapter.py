@@ -1,43 +1,113 @@
 #!venv/bin/python
 import logging
 
+from peewee import ForeignKeyField
+
 class Adapter:
-    def __init__(self, model_cls, parent_cls=None, **kwargs):
+    # Optional DatabaseRouter; reads go to its replicas and writes mark the client as sticky.
+    router = None
+
+    # Optional retention.Archive holding rows of model_cls that were moved out of the database.
+    archive = None
+
+    # Optional search.SearchIndex kept in step with writes to the models it supports.
+    search_index = None
+
+    def __init__(self, model_cls, parent_cls=None, write_behind=None, **kwargs):
         self.model_cls = model_cls
         self.parent_cls = parent_cls
 
+        # Optional writebehind.WriteBehind that group-commits creates.
+        self.write_behind = write_behind
+
+        # The foreign key a join on parent_cls follows.
+        self.parent_field = None
+        if parent_cls:
+            self.parent_field = next((f for f in model_cls._meta.sorted_fields if isinstance(f, ForeignKeyField) and f.rel_model is parent_cls), None)
+
+    def route(self, query, primary=False):
+        if self.router:
+            query = self.router.route(query, primary=primary)
+        return query
+
+    def wrote(self):
+        if self.router:
+            self.router.write()
+
+    def index(self, o, database=None):
+        if self.search_index and self.search_index.supports(self.model_cls):
+            self.search_index.add(database or self.model_cls._meta.database, o)
+
+    def unindex(self, o, database=None):
+        if self.search_index and self.search_index.supports(self.model_cls):
+            self.search_index.remove(database or self.model_cls._meta.database, self.model_cls, [o.id])
+
+    def commit(self, database, fn):
+        """fn() in a transaction of its own, or in the next group commit with write_behind."""
+        if self.write_behind:
+            return self.write_behind.submit(database, fn)
+
+        with database.atomic():
+            return fn()
+
     def create_one(self, parent=None, **kwargs):
-        return self.model_cls.create(**kwargs)
+        def create():
+            o = self.model_cls.create(**kwargs)
+            self.index(o)
+            return o
 
-    def read_all(self, parent, **kwargs):
-        query = self.model_cls.select()
+        o = self.commit(self.model_cls._meta.database, create)
+        self.wrote()
+        return o
+
+    def scope(self, query, parent):
         if self.parent_cls and parent:
             query = query.join(self.parent_cls).where(self.parent_cls.id == parent)
-
         return query
 
-    def read_one(self, id, parent=None, **kwargs):
+    def read_all(self, parent, **kwargs):
+        return self.route(self.scope(self.model_cls.select(), parent))
+
+    def read_many(self, ids, parent=None, **kwargs):
+        """Instances by id in one query, scoped to parent like read_all; missing ids are left out."""
+        query = self.scope(self.model_cls.select().where(self.model_cls.id << list(ids)), parent)
+        return {o.id: o for o in self.route(query)}
+
+    def read_one(self, id, parent=None, primary=False, **kwargs):
         try:
-            return self.model_cls.select().where(self.model_cls.id == id).get()
+            return self.route(self.model_cls.select().where(self.model_cls.id == id), primary=primary).get()
         except self.model_cls.DoesNotExist as e:
-            logging.exception('read_one failed')
+            logging.debug('read_one failed: model=%s, id=%s', self.model_cls.__name__, id)
             raise e
 
+    def read_archived(self, parent=None, id=None, **kwargs):
+        if not self.archive:
+            return []
+
+        field = self.parent_field if parent else None
+        return self.archive.read(self.model_cls, field=field, value=parent, id=id)
+
     def update_one(self, id, parent=None, **kwargs):
-        o = self.read_one(id=id, parent=parent, **kwargs)
+        o = self.read_one(id=id, parent=parent, primary=True)
         if o:
             for (k, v) in kwargs.items():
                 o.__setattr__(k, v)
-            o.save()
+            with self.model_cls._meta.database.atomic():
+                o.save()
+                self.index(o)
+            self.wrote()
         return o
 
     def patch_one(self, id, parent=None, **kwargs):
         self.update_one(id=id, parent=parent, **kwargs)
 
     def delete_one(self, id, parent=None, **kwargs):
-        o = self.read_one(id=id, parent=parent, **kwargs)
+        o = self.read_one(id=id, parent=parent, primary=True)
         if o:
-            self.model_cls.delete_instance(o)
+            with self.model_cls._meta.database.atomic():
+                self.model_cls.delete_instance(o)
+                self.unindex(o)
+            self.wrote()
         return o
 
     def __str__(self):
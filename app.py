@@ -3,44 +3,67 @@ import logging
 
 from functools import wraps
 
-import werkzeug.routing
-
 from flask import abort
 from flask import redirect
 from flask import Flask
 from flask import g
 from flask import jsonify
 from flask import make_response
+from flask import request
+from flask import url_for
 
 from flask_httpauth import HTTPBasicAuth
 
-from pbkdf2 import crypt
-
 from playhouse.flask_utils import FlaskDB
 
+import compress
+import log
+
 from adapter import Adapter
 from model import ALL_MODELS
+from model import BaseModel
 from model import Config
 from model import Device
 from model import Group
 from model import Message
 from model import Publication
+from model import Retention
 from model import Subscription
 from model import User
-from schema import ConfigSchema
-from schema import DeviceSchema
-from schema import GroupSchema
-from schema import MessageSchema
-from schema import PublicationSchema
-from schema import SubscriptionSchema
-from schema import UserSchema
+from passwords import Passwords
+from ratelimit import RateLimiter
+from retention import Archive
+from router import DatabaseRouter
+from search import MAX_PER_PAGE
+from search import SearchIndex
+from shard import ShardedAdapter
+from shard import ShardMap
 from view import View
-
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s.%(msecs)d %(levelname)s %(threadName)s(%(thread)d) %(module)s.%(funcName)s#%(lineno)d %(message)s', datefmt='%d.%m.%Y %H:%M:%S')
+from writebehind import WriteBehind
 
 app = Flask(__name__, static_url_path = '')
 
-database = FlaskDB(app, 'sqlite:///peewee.db')
+# Bound to the app by create_app().
+database = FlaskDB(database='sqlite:///peewee.db')
+
+router = DatabaseRouter.from_env(primary=BaseModel._meta.database)
+
+shards = ShardMap.from_env()
+
+archive = Archive.from_env()
+
+passwords = Passwords.from_env()
+
+limiter = RateLimiter.from_env()
+
+# Group-commits message creates when WRITE_BEHIND_ROWS is set.
+write_behind = WriteBehind.from_env()
+
+# Requests per period seconds for the endpoints devices poll.
+MESSAGES_RATE = '60/60'
+SEARCH_RATE = '30/60'
+
+search_index = SearchIndex()
 
 auth = HTTPBasicAuth()
 
@@ -48,12 +71,12 @@ class AuthExt:
     @classmethod
     def save(cls, user, **kwargs):
         g.current_user = user if user else None
-        admin_group = Group.select().where(Group.name == 'admin').get()
-        g.is_admin = admin_group.is_member(g.current_user)
+        admin_group = router.route(Group.select().where(Group.name == 'admin')).get()
+        g.is_admin = admin_group.is_member(g.current_user, database=router.read())
 
     @classmethod
     def is_admin(cls, *args, **kwargs):
-        logging.debug('args={}, kwargs={}, g={}'.format(args, kwargs, g))
+        logging.debug('args=%s, kwargs=%s, g=%s', args, kwargs, g)
         try:
             return g.is_admin
         except:
@@ -63,7 +86,7 @@ class AuthExt:
 
     @classmethod
     def is_parent_user(cls, *args, **kwargs):
-        logging.debug('args={}, kwargs={}, g={}'.format(args, kwargs, g))
+        logging.debug('args=%s, kwargs=%s, g=%s', args, kwargs, g)
         try:
             if int(kwargs['parent']) == g.current_user.id:
                 return True
@@ -80,7 +103,7 @@ class AuthExt:
     def admin_required(f):
         @wraps(f)
         def decorated(*args, **kwargs):
-            logging.debug('args={}, kwargs={}'.format(args, kwargs))
+            logging.debug('args=%s, kwargs=%s', args, kwargs)
 
             if AuthExt.is_admin(*args, **kwargs):
                 return f(*args, **kwargs)
@@ -92,7 +115,7 @@ class AuthExt:
     def admin_or_parent(f):
         @wraps(f)
         def decorated(*args, **kwargs):
-            logging.debug('args={}, kwargs={}'.format(id, args, kwargs))
+            logging.debug('args=%s, kwargs=%s', args, kwargs)
 
             if AuthExt.is_admin(*args, **kwargs):
                 return f(*args, **kwargs)
@@ -106,11 +129,17 @@ class AuthExt:
 @auth.verify_password
 def verify_password(username, alleged_password):
     try:
-        user = User.select().where(User.username == username).get()
-        verification = (crypt(alleged_password, user.password) == user.password)
-        logging.debug('verify_password: username={}, encrypted_password={}, alleged_password={}, verification={}'.format(username, user.password, alleged_password, verification))
+        user = router.route(User.select().where(User.username == username)).get()
+        verification = user.check_password(alleged_password)
+        logging.debug('verify_password: username=%s, verification=%s', username, verification)
 
         if verification:
+            try:
+                user.rehash_password(alleged_password)
+            except Exception:
+                # The old hash still works; try again on the next login.
+                logging.exception('rehash_password')
+
             AuthExt.save(user=user)
 
         return verification
@@ -131,33 +160,102 @@ def not_found(error):
 def not_found(error):
     return make_response(jsonify({'error': 'Not found'}), 404)
 
+@app.errorhandler(503)
+def unavailable(error):
+    response = make_response(jsonify({'error': 'Service unavailable'}), 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
 @app.route('/')
 @auth.login_required
 def index():
     return redirect('/index.html')
 
+@auth.login_required
+@limiter.limit
+def search():
+    term = request.args.get('q', '').strip()
+    if not term:
+        abort(400)
+
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 20)), 1), MAX_PER_PAGE)
+    except ValueError:
+        abort(400)
+
+    # Admins see everything; everyone else only rows listed under their own user, the only routes they may read.
+    owner = None if AuthExt.is_admin() else g.current_user.id
+
+    databases = [BaseModel._meta.database] + shards.shards
+    results = search_index.search(databases, term, owner=owner, kind=request.args.get('kind'), page=page, per_page=per_page)
+
+    return jsonify([{
+        'kind': kind,
+        'id': ref,
+        'uri': url_for(kind + 's', id=ref, parent=owner, _external=True),
+        'score': score,
+        'snippet': snippet,
+    } for (score, kind, ref, owner, snippet) in results])
+
 def prepare_routes(base_url='/api/v1.0/'):
-    View.decorators = [AuthExt.admin_or_parent, auth.login_required]
+    View.decorators = [AuthExt.admin_or_parent, limiter.limit, auth.login_required]
+    View.limiter = limiter
+    Adapter.router = router
+    Adapter.search_index = search_index
+    User.passwords = passwords
+    ShardedAdapter.shards = shards
+    ShardedAdapter.archive = archive
+
+    # Adapters are passed as factories and schemas as import paths; each endpoint builds them on its first request.
 
     # Admin-only.
-    View.add(app, base_url=[base_url + 'configs'], endpoint='configs', adapter=Adapter(model_cls=Config), schema_cls=ConfigSchema)
+    View.add(app, base_url=[base_url + 'configs'], endpoint='configs', adapter=lambda: Adapter(model_cls=Config), schema_cls='schema.ConfigSchema')
+
+    View.add(app, base_url=[base_url + 'retentions'], endpoint='retentions', adapter=lambda: Adapter(model_cls=Retention), schema_cls='schema.RetentionSchema')
+
+    View.add(app, base_url=[base_url + 'groups'], endpoint='groups', adapter=lambda: Adapter(model_cls=Group), schema_cls='schema.GroupSchema')
+
+    View.add(app, base_url=[base_url + 'users'], endpoint='users', adapter=lambda: Adapter(model_cls=User), schema_cls='schema.UserSchema')
+
+    View.add(app, base_url=[base_url + 'users/<string:parent>/devices', base_url + 'devices'], endpoint='devices', adapter=lambda: Adapter(model_cls=Device, parent_cls=User), schema_cls='schema.DeviceSchema')
+    View.add(app, base_url=base_url + 'users/<string:user_id>/devices/<string:parent>/messages', endpoint='devices.messages', adapter=lambda: ShardedAdapter(model_cls=Message, parent_cls=Device, write_behind=write_behind), schema_cls='schema.MessageSchema', rate=MESSAGES_RATE)
+
+    View.add(app, base_url=[base_url + 'users/<string:parent>/publications', base_url + 'publications'], endpoint='publications', adapter=lambda: Adapter(model_cls=Publication, parent_cls=User), schema_cls='schema.PublicationSchema')
+    View.add(app, base_url=base_url + 'users/<string:user_id>/publications/<string:parent>/subscriptions', endpoint='publication.subscriptions', adapter=lambda: Adapter(model_cls=Subscription, parent_cls=Publication), schema_cls='schema.SubscriptionSchema')
+    View.add(app, base_url=base_url + 'users/<string:user_id>/publications/<string:parent>/messages', endpoint='publication.messages', adapter=lambda: ShardedAdapter(model_cls=Message, parent_cls=Publication, write_behind=write_behind), schema_cls='schema.MessageSchema', rate=MESSAGES_RATE)
+
+    View.add(app, base_url=[base_url + 'users/<string:parent>/subscriptions', base_url + 'subscriptions'], endpoint='subscriptions', adapter=lambda: Adapter(model_cls=Subscription, parent_cls=User), schema_cls='schema.SubscriptionSchema')
+    #View.add(app, base_url=base_url + 'users/<string:user_id>/subscriptions/<string:parent>/messages', endpoint='subscription.messages', adapter=lambda: Adapter(model_cls=Message, parent_cls=Subscription), schema_cls='schema.MessageSchema')
+
+    View.add(app, base_url=[base_url + 'users/<string:parent>/messages', base_url + 'messages'], endpoint='messages', adapter=lambda: ShardedAdapter(model_cls=Message, parent_cls=User, write_behind=write_behind), schema_cls='schema.MessageSchema', rate=MESSAGES_RATE)
+
+    app.add_url_rule(base_url + 'search', 'search', search)
+    limiter.set_rate('search', SEARCH_RATE)
+
+prepared = False
 
-    View.add(app, base_url=[base_url + 'groups'], endpoint='groups', adapter=Adapter(model_cls=Group), schema_cls=GroupSchema)
+def create_app(base_url='/api/v1.0/', warm=False):
+    """Configure logging, middleware and routes, once per process, and return the app.
 
-    View.add(app, base_url=[base_url + 'users'], endpoint='users', adapter=Adapter(model_cls=User), schema_cls=UserSchema)
+    Importing this module only defines the app; entry points call this instead. With warm, every endpoint's
+    adapter and schemas are built now rather than on its first request.
+    """
+    global prepared
 
-    View.add(app, base_url=[base_url + 'users/<string:parent>/devices', base_url + 'devices'], endpoint='devices', adapter=Adapter(model_cls=Device, parent_cls=User), schema_cls=DeviceSchema)
-    View.add(app, base_url=base_url + 'users/<string:user_id>/devices/<string:parent>/messages', endpoint='devices.messages', adapter=Adapter(model_cls=Message, parent_cls=Device), schema_cls=MessageSchema)
+    if not prepared:
+        prepared = True
 
-    View.add(app, base_url=[base_url + 'users/<string:parent>/publications', base_url + 'publications'], endpoint='publications', adapter=Adapter(model_cls=Publication, parent_cls=User), schema_cls=PublicationSchema)
-    View.add(app, base_url=base_url + 'users/<string:user_id>/publications/<string:parent>/subscriptions', endpoint='publication.subscriptions', adapter=Adapter(model_cls=Subscription, parent_cls=Publication), schema_cls=SubscriptionSchema)
-    View.add(app, base_url=base_url + 'users/<string:user_id>/publications/<string:parent>/messages', endpoint='publication.messages', adapter=Adapter(model_cls=Message, parent_cls=Publication), schema_cls=MessageSchema)
+        log.configure()
+        log.init_access_log(app)
+        compress.init_compression(app)
+        database.init_app(app)
+        prepare_routes(base_url)
 
-    View.add(app, base_url=[base_url + 'users/<string:parent>/subscriptions', base_url + 'subscriptions'], endpoint='subscriptions', adapter=Adapter(model_cls=Subscription, parent_cls=User), schema_cls=SubscriptionSchema)
-    #View.add(app, base_url=base_url + 'users/<string:user_id>/subscriptions/<string:parent>/messages', endpoint='subscription.messages', adapter=Adapter(model_cls=Message, parent_cls=Subscription), schema_cls=MessageSchema)
+    if warm:
+        View.warm(app)
 
-    View.add(app, base_url=[base_url + 'users/<string:parent>/messages', base_url + 'messages'], endpoint='messages', adapter=Adapter(model_cls=Message, parent_cls=User), schema_cls=MessageSchema)
+    return app
 
 if __name__ == '__main__':
-    prepare_routes()
-    app.run(debug=True)
+    create_app().run(debug=True)
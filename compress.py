@@ -0,0 +1,281 @@
+#!venv/bin/python
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from flask import Flask
+from flask import Response
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_MIN_SIZE = 500
+DEFAULT_LEVEL = 6
+
+# One week; ETags let clients revalidate after that without downloading the file again.
+DEFAULT_STATIC_MAX_AGE = 7 * 24 * 3600
+
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+
+def encodings():
+    """Supported encodings, most preferred first."""
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+def choose_encoding(accept_encoding):
+    """The preferred supported encoding the client accepts (q > 0), or None for identity."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        (coding, _, params) = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+
+    for encoding in encodings():
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+
+    return None
+
+def is_compressible(mimetype):
+    return bool(mimetype) and mimetype.startswith(COMPRESSIBLE)
+
+def compress(data, encoding, level=DEFAULT_LEVEL):
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=level)
+
+def compress_stream(chunks, encoding, level=DEFAULT_LEVEL):
+    """Compress an iterable of chunks, flushing after each so streamed output is not held back."""
+    chunks = (chunk.encode('utf-8') if isinstance(chunk, str) else chunk for chunk in chunks)
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=min(level, 11))
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+        return
+
+    # wbits 31: zlib stream with a gzip header and trailer.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def add_vary(response):
+    vary = [v.strip() for v in response.headers.get('Vary', '').split(',') if v.strip()]
+    if 'Accept-Encoding' not in vary:
+        response.headers['Vary'] = ', '.join(vary + ['Accept-Encoding'])
+
+class StaticFiles:
+    """A static folder's compressible files, read and compressed once, served with ETags and Cache-Control."""
+
+    def __init__(self, folder, max_age=DEFAULT_STATIC_MAX_AGE, level=9):
+        self.folder = folder
+        self.max_age = max_age
+        self.files = {}
+
+        for (dirpath, _, filenames) in os.walk(folder):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                mimetype = mimetypes.guess_type(filename)[0]
+                if not is_compressible(mimetype):
+                    continue
+
+                with open(path, 'rb') as f:
+                    data = f.read()
+
+                etag = hashlib.sha1(data).hexdigest()[:20]
+                variants = {None: data}
+                for encoding in encodings():
+                    variants[encoding] = compress(data, encoding, level=level)
+
+                self.files[os.path.relpath(path, folder).replace(os.sep, '/')] = (mimetype, etag, variants)
+
+        logging.info('precompressed static files: folder=%s, files=%d', folder, len(self.files))
+
+    def response(self, filename):
+        """The response for filename, or None if it was not precompressed."""
+        found = self.files.get(filename)
+        if found is None:
+            return None
+
+        (mimetype, etag, variants) = found
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        etag = '{}-{}'.format(etag, encoding) if encoding else etag
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(variants[encoding], mimetype=mimetype)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, max-age={}'.format(self.max_age)
+        add_vary(response)
+        return response
+
+def init_compression(app, min_size=None, level=None, static_max_age=None):
+    """Compress responses the client accepts, and serve precompressed static files.
+
+    Bodies smaller than min_size (COMPRESS_MIN_SIZE, default 500 bytes) are sent as they are. Static files
+    are cached for static_max_age seconds (STATIC_MAX_AGE, default one week).
+    """
+    if min_size is None:
+        min_size = int(os.environ.get('COMPRESS_MIN_SIZE', DEFAULT_MIN_SIZE))
+    if level is None:
+        level = int(os.environ.get('COMPRESS_LEVEL', DEFAULT_LEVEL))
+    if static_max_age is None:
+        static_max_age = int(os.environ.get('STATIC_MAX_AGE', DEFAULT_STATIC_MAX_AGE))
+
+    if app.static_folder and os.path.isdir(app.static_folder):
+        static_files = StaticFiles(app.static_folder, max_age=static_max_age)
+        send_static_file = app.view_functions['static']
+
+        def static(filename):
+            return static_files.response(filename) or send_static_file(filename=filename)
+
+        app.view_functions['static'] = static
+
+    @app.after_request
+    def compress_response(response):
+        if response.status_code < 200 or response.status_code in (204, 304) or request.method == 'HEAD':
+            return response
+        if response.direct_passthrough or 'Content-Encoding' in response.headers or not is_compressible(response.mimetype):
+            return response
+
+        if response.is_streamed:
+            add_vary(response)
+            encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+            if encoding:
+                response.response = compress_stream(response.response, encoding, level=level)
+                response.headers['Content-Encoding'] = encoding
+                response.headers.pop('Content-Length', None)
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        add_vary(response)
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding:
+            response.set_data(compress(data, encoding, level=level))
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    return app
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dir, 'index.html'), 'w') as f:
+            f.write('<html>' + 'hello ' * 200 + '</html>')
+        with open(os.path.join(self.dir, 'logo.png'), 'wb') as f:
+            f.write(b'\x89PNG')
+
+        app = Flask(__name__, static_folder=self.dir, static_url_path='')
+
+        @app.route('/small')
+        def small():
+            return Response('{"a": 1}', mimetype='application/json')
+
+        @app.route('/large')
+        def large():
+            return Response('[' + ', '.join(['{"a": 1}'] * 200) + ']', mimetype='application/json')
+
+        @app.route('/stream')
+        def stream():
+            return Response((str(i) * 100 for i in range(5)), mimetype='text/plain')
+
+        init_compression(app, min_size=500, level=6, static_max_age=60)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get(self, url, encoding='gzip', **headers):
+        if encoding:
+            headers['Accept-Encoding'] = encoding
+        return self.client.get(url, headers=headers)
+
+    def test_choose_encoding(self):
+        self.assertEqual(choose_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(choose_encoding('gzip;q=0'), None)
+        self.assertEqual(choose_encoding('*'), encodings()[0])
+        self.assertEqual(choose_encoding('identity'), None)
+        self.assertEqual(choose_encoding(None), None)
+
+    def test_small(self):
+        response = self.get('/small')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_data(), b'{"a": 1}')
+
+    def test_large(self):
+        response = self.get('/large')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(int(response.headers['Content-Length']), len(response.get_data()))
+        self.assertTrue(gzip.decompress(response.get_data()).startswith(b'[{"a": 1}'))
+
+    def test_not_accepted(self):
+        response = self.get('/large', encoding=None)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+    def test_stream(self):
+        response = self.get('/stream')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(gzip.decompress(response.get_data()), ''.join(str(i) * 100 for i in range(5)).encode('ascii'))
+
+    def test_static(self):
+        response = self.get('/index.html')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=60')
+        self.assertTrue(gzip.decompress(response.get_data()).startswith(b'<html>hello'))
+
+        etag = response.headers['ETag']
+        response = self.get('/index.html', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+
+        response = self.get('/index.html', encoding=None, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_static_fallback(self):
+        response = self.get('/logo.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        response.close()
+
+        self.assertEqual(self.get('/missing.html').status_code, 404)
+
+    @unittest.skipUnless(brotli, 'brotli is not installed')
+    def test_brotli(self):
+        response = self.get('/large', encoding='gzip, br')
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertTrue(brotli.decompress(response.get_data()).startswith(b'[{"a": 1}'))
+
+        response = self.get('/stream', encoding='br')
+        self.assertEqual(brotli.decompress(response.get_data()), ''.join(str(i) * 100 for i in range(5)).encode('ascii'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+#!venv/bin/python
+import unittest
+
+from peewee import CharField
+from peewee import Model
+from peewee import SqliteDatabase
+
+# Bound on the parameters of one statement; older SQLite builds reject more than 999.
+MAX_VARIABLES = 999
+
+def on(query, database):
+    """query, bound to run on database instead of its model's database."""
+    query.database = database
+    return query
+
+class Item(Model):
+    name = CharField()
+
+class TestOn(unittest.TestCase):
+    def test_on(self):
+        database = SqliteDatabase(':memory:')
+        database.execute_sql('CREATE TABLE item (id INTEGER PRIMARY KEY, name VARCHAR(255))')
+        database.execute_sql("INSERT INTO item (name) VALUES ('a')")
+
+        query = Item.select()
+        self.assertIs(on(query, database), query)
+        self.assertEqual([o.name for o in query], ['a'])
+
+if __name__ == '__main__':
+    unittest.main()
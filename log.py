@@ -0,0 +1,195 @@
+#!venv/bin/python
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+import unittest
+
+from flask import Flask
+from flask import g
+from flask import request
+
+FORMAT = '%(asctime)s.%(msecs)d %(levelname)s %(threadName)s(%(thread)d) %(module)s.%(funcName)s#%(lineno)d %(message)s'
+DATEFMT = '%d.%m.%Y %H:%M:%S'
+
+access_logger = logging.getLogger('access')
+
+_queue_handler = None
+_listener = None
+
+def configure(level=None, handlers=None):
+    """Route all logging through a queue so handler I/O runs on a background thread.
+
+    The level defaults to the LOG_LEVEL environment variable (INFO if unset).
+    """
+    global _queue_handler, _listener
+
+    level = level or os.environ.get('LOG_LEVEL', 'INFO')
+    if not handlers:
+        handlers = [logging.StreamHandler()]
+
+    for handler in handlers:
+        if not handler.formatter:
+            handler.setFormatter(logging.Formatter(FORMAT, datefmt=DATEFMT))
+
+    shutdown()
+
+    q = queue.Queue(-1)
+    _queue_handler = logging.handlers.QueueHandler(q)
+    _listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+    _listener.start()
+    return _listener
+
+def shutdown():
+    """Flush queued records and detach the queue handler."""
+    global _queue_handler, _listener
+
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+    if _queue_handler:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+
+atexit.register(shutdown)
+
+def _after_fork_in_child():
+    # The listener thread does not survive fork(); give the child its own queue and thread.
+    global _listener
+
+    if _listener:
+        q = queue.Queue(-1)
+        _queue_handler.queue = q
+        _listener = logging.handlers.QueueListener(q, *_listener.handlers, respect_handler_level=True)
+        _listener.start()
+
+# Unix only; there is no fork() to survive elsewhere.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def init_access_log(app, sample_rate=None):
+    """Emit one key=value access record per request.
+
+    Only a sample_rate fraction of successful requests is logged (ACCESS_LOG_SAMPLE_RATE, default 1.0);
+    server errors are always logged.
+    """
+    if sample_rate is None:
+        sample_rate = float(os.environ.get('ACCESS_LOG_SAMPLE_RATE', 1.0))
+
+    @app.before_request
+    def access_log_start():
+        g.request_started = time.time()
+
+    @app.after_request
+    def access_log(response):
+        if not access_logger.isEnabledFor(logging.INFO):
+            return response
+
+        if response.status_code < 500 and random.random() >= sample_rate:
+            return response
+
+        started = getattr(g, 'request_started', None)
+        duration_ms = (time.time() - started) * 1000 if started else 0.0
+        user = getattr(g, 'current_user', None)
+
+        access_logger.info('method=%s path=%s status=%d bytes=%s duration_ms=%.1f user=%s remote=%s',
+            request.method, request.path, response.status_code, response.content_length,
+            duration_ms, user.id if user else '-', request.remote_addr)
+        return response
+
+    return app
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class Expensive:
+    def __init__(self):
+        self.calls = 0
+
+    def __str__(self):
+        self.calls += 1
+        return 'expensive'
+
+class TestConfigure(unittest.TestCase):
+    def setUp(self):
+        self.handler = ListHandler()
+        configure(level='INFO', handlers=[self.handler])
+
+    def tearDown(self):
+        shutdown()
+
+    def test_queued(self):
+        logging.getLogger('test').info('a=%s', 1)
+        shutdown()
+        self.assertEqual([r.getMessage() for r in self.handler.records], ['a=1'])
+
+    def test_lazy(self):
+        o = Expensive()
+        logging.getLogger('test').debug('o=%s', o)
+        shutdown()
+        self.assertEqual(o.calls, 0)
+        self.assertEqual(self.handler.records, [])
+
+class TestFork(unittest.TestCase):
+    def setUp(self):
+        self.path = 'test_log_fork.log'
+        configure(level='INFO', handlers=[logging.FileHandler(self.path)])
+
+    def tearDown(self):
+        shutdown()
+        os.remove(self.path)
+
+    def test_child_logs(self):
+        pid = os.fork()
+        if not pid:
+            logging.getLogger('test').info('from child')
+            shutdown()
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+        with open(self.path) as f:
+            self.assertIn('from child', f.read())
+
+class TestAccessLog(unittest.TestCase):
+    def setUp(self):
+        self.handler = ListHandler()
+        configure(level='INFO', handlers=[self.handler])
+
+    def tearDown(self):
+        shutdown()
+
+    def request(self, sample_rate, status):
+        app = Flask(__name__)
+        app.add_url_rule('/', 'index', lambda: ('', status))
+        init_access_log(app, sample_rate=sample_rate)
+        app.test_client().get('/')
+        shutdown()
+        return [r for r in self.handler.records if r.name == 'access']
+
+    def test_logged(self):
+        records = self.request(sample_rate=1.0, status=200)
+        self.assertEqual(len(records), 1)
+        self.assertIn('method=GET path=/ status=200', records[0].getMessage())
+
+    def test_sampled_out(self):
+        self.assertEqual(self.request(sample_rate=0.0, status=200), [])
+
+    def test_errors_always_logged(self):
+        self.assertEqual(len(self.request(sample_rate=0.0, status=500)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,129 @@
 #!venv/bin/python
+import argparse
 import json
 import logging
 import os
+import time
 import unittest
 
 from peewee import SqliteDatabase
 
+from playhouse.db_url import connect
+
+import bulk
+import log
+import retention
+import search
+import shard
+
 from model import ALL_MODELS
+from model import BaseModel
+from model import Route
+
+def create(args):
+    BaseModel._meta.database.create_tables(ALL_MODELS, safe=True)
+    shard.create_tables(shard.ShardMap.from_env())
+
+def rebalance(args):
+    shard_map = shard.ShardMap.from_env()
+    shard.create_tables(shard_map)
+
+    retired = [connect(url) for url in args.retired]
+    if args.from_primary:
+        retired.append(BaseModel._meta.database)
+
+    moved = shard.rebalance(shard_map, retired=retired, batch_size=args.batch_size, search_index=search.SearchIndex())
+    logging.info('rebalance: moved=%d', moved)
+
+def archive(args):
+    shard_map = shard.ShardMap.from_env()
+    databases = shard_map.shards or [BaseModel._meta.database]
+    message_archive = retention.Archive.from_env()
+    search_index = search.SearchIndex()
+
+    while True:
+        archived = retention.apply_policies(databases, message_archive, batch_size=args.batch_size, search_index=search_index)
+        logging.info('archive: archived=%d', archived)
+
+        if args.vacuum and archived:
+            for database in databases:
+                database.execute_sql('VACUUM')
+
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+def rebuild_search(args):
+    search_index = search.SearchIndex()
+    for database in [BaseModel._meta.database] + shard.ShardMap.from_env().shards:
+        search_index.rebuild(database, batch_size=args.batch_size)
+
+def export(args):
+    shard_map = shard.ShardMap.from_env()
+    extra_databases = {model_cls: shard_map.shards for model_cls in shard.SHARDED_MODELS}
+
+    with bulk.open_file(args.path, 'w') as f:
+        exported = bulk.export(f, BaseModel._meta.database, extra_databases=extra_databases)
+    logging.info('export: exported=%d', exported)
+
+def import_(args):
+    database = BaseModel._meta.database
+    database.create_tables(ALL_MODELS, safe=True)
+
+    with bulk.open_file(args.path, 'r') as f:
+        loaded = bulk.load(f, database, batch_size=args.batch_size, replace=args.replace)
+    logging.info('import: loaded=%d', loaded)
+
+    Route.refresh()
+    search.SearchIndex().rebuild(database)
+
+def rebuild_routes(args):
+    Route.refresh()
+    logging.info('rebuild-routes: routes=%d', Route.select().count())
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Manage the database.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparser = subparsers.add_parser('create', help='create missing tables, including on MESSAGE_SHARDS')
+    subparser.set_defaults(func=create)
+
+    subparser = subparsers.add_parser('rebalance', help='move messages onto the shard MESSAGE_SHARDS assigns them')
+    subparser.add_argument('--retired', nargs='*', default=[], help='database URLs of removed shards to drain')
+    subparser.add_argument('--from-primary', action='store_true', help='migrate messages out of the unsharded primary database')
+    subparser.add_argument('--batch-size', type=int, default=500)
+    subparser.set_defaults(func=rebalance)
+
+    subparser = subparsers.add_parser('archive', help='move messages outside their retention policy to MESSAGE_ARCHIVE_DIR')
+    subparser.add_argument('--batch-size', type=int, default=retention.DEFAULT_BATCH_SIZE, help='messages per delete transaction')
+    subparser.add_argument('--interval', type=int, default=0, help='repeat every INTERVAL seconds instead of running once')
+    subparser.add_argument('--vacuum', action='store_true', help='reclaim space after archiving')
+    subparser.set_defaults(func=archive)
+
+    subparser = subparsers.add_parser('export', help='write every table as NDJSON, including messages on MESSAGE_SHARDS')
+    subparser.add_argument('path', help='output file, gzip-compressed if it ends in .gz, or - for stdout')
+    subparser.set_defaults(func=export)
+
+    subparser = subparsers.add_parser('import', help='load a file written by export into the main database')
+    subparser.add_argument('path', help='input file, gzip-compressed if it ends in .gz, or - for stdin')
+    subparser.add_argument('--batch-size', type=int, default=bulk.DEFAULT_BATCH_SIZE, help='rows per transaction')
+    subparser.add_argument('--replace', action='store_true', help='overwrite rows that already exist instead of failing')
+    subparser.set_defaults(func=import_)
+
+    subparser = subparsers.add_parser('rebuild-search', help='reindex messages and publications for /search, including on MESSAGE_SHARDS')
+    subparser.add_argument('--batch-size', type=int, default=1000)
+    subparser.set_defaults(func=rebuild_search)
+
+    subparser = subparsers.add_parser('rebuild-routes', help='recompute every publication\'s subscriber devices')
+    subparser.set_defaults(func=rebuild_routes)
+
+    return parser.parse_args(args)
+
+def main(args=None):
+    log.configure()
+    args = parse_args(args)
+    args.func(args)
 
 class TestManage(unittest.TestCase):
     def setUp(self):
@@ -19,6 +136,15 @@ class TestManage(unittest.TestCase):
     def testCreate(self):
         self.db.create_tables(ALL_MODELS, safe=True)
 
+    def testParse(self):
+        args = parse_args(['rebalance', '--from-primary', '--retired', 'sqlite:///a.db'])
+        self.assertEqual(args.func, rebalance)
+        self.assertTrue(args.from_primary)
+        self.assertEqual(args.retired, ['sqlite:///a.db'])
+
+        args = parse_args(['import', 'dump.ndjson.gz', '--replace'])
+        self.assertEqual(args.func, import_)
+        self.assertTrue(args.replace)
+
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG, format='%(levelname)s %(module)s.%(funcName)s#%(lineno)d %(message)s')
-    unittest.main()
\ No newline at end of file
+    main()
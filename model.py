@@ -1,20 +1,27 @@
 #!venv/bin/python
 import datetime
 import logging
+import operator
 import uuid
 import unittest
 
-from flask import url_for
+from functools import reduce
 
-from pbkdf2 import crypt
+from flask import url_for
 
 from peewee import CharField
 from peewee import CompositeKey
 from peewee import DateTimeField
+from peewee import DeleteQuery
 from peewee import ForeignKeyField
 from peewee import IntegerField
 from peewee import Model
 from peewee import SqliteDatabase
+from peewee import UpdateQuery
+
+from db import MAX_VARIABLES
+from db import on
+from passwords import Passwords
 
 class BaseModel(Model):
     created = DateTimeField(default=datetime.datetime.now)
@@ -33,35 +40,121 @@ class BaseModel(Model):
     def uri(self):
         return url_for(endpoint=self.endpoint, id=self.id, parent=self.parent_id, _external=True)
 
-    def save(self, *args, **kwargs):
+    def touch(self):
         self.modified = datetime.datetime.now()
         self.revision += 1
+
+    def save(self, *args, **kwargs):
+        self.touch()
         super(BaseModel, self).save(*args, **kwargs)
 
     def __str__(self):
         return 'id={}, uri={}, created={}, modified={}, revision={}'.format(self.id, self.uri, self.created, self.modified, self.revision)
 
+class RoutedUpdateQuery(UpdateQuery):
+    """An update that refreshes the routes of the rows it changes, for the rows whose route_fields it changes."""
+
+    def execute(self):
+        model_cls = self.model_class
+        changes = [field != value for (field, value) in self._update.items() if field.name in model_cls.route_fields]
+        if not changes:
+            return super(RoutedUpdateQuery, self).execute()
+
+        with self.database.atomic():
+            # save() writes every field, so a rename also "sets" the route fields; only rows they differ on need new routes.
+            moved = model_cls.matching(self._where).where(reduce(operator.or_, changes))
+            ids = [id for (id, ) in on(moved, self.database).tuples()]
+            rows = super(RoutedUpdateQuery, self).execute()
+            for i in range(0, len(ids), MAX_VARIABLES):
+                model_cls.refresh_routes(ids[i:i + MAX_VARIABLES], self.database)
+        return rows
+
+class RoutedDeleteQuery(DeleteQuery):
+    """A delete that also deletes the routes derived from the rows it deletes."""
+
+    def execute(self):
+        model_cls = self.model_class
+        with self.database.atomic():
+            on(Route.delete().where(model_cls.derived_routes(model_cls.matching(self._where))), self.database).execute()
+            return super(RoutedDeleteQuery, self).execute()
+
+class Routed:
+    """Keeps Route current through every update and delete of a model it is derived from, including bulk queries."""
+
+    # Fields whose new values change the model's routes.
+    route_fields = ()
+
+    @classmethod
+    def update(cls, __data=None, **update):
+        fdict = __data or {}
+        fdict.update([(cls._meta.fields[f], update[f]) for f in update])
+        return RoutedUpdateQuery(cls, fdict)
+
+    @classmethod
+    def delete(cls):
+        return RoutedDeleteQuery(cls)
+
+    @classmethod
+    def matching(cls, where):
+        query = cls.select(cls.id)
+        return query if where is None else query.where(where)
+
+    @classmethod
+    def derived_routes(cls, ids):
+        """Expression matching the routes derived from the rows that ids, a query of ids, selects."""
+        raise NotImplementedError
+
+    @classmethod
+    def refresh_routes(cls, ids, database):
+        """Recompute the routes of the rows with ids; only models with route_fields have any to recompute."""
+        pass
+
+    def save(self, *args, **kwargs):
+        # Updates refresh their routes in RoutedUpdateQuery; inserts refresh them here.
+        inserting = kwargs.get('force_insert') or self._get_pk_value() is None
+        with self._meta.database.atomic():
+            rows = super(Routed, self).save(*args, **kwargs)
+            if inserting:
+                self.refresh_routes([self.id], self._meta.database)
+        return rows
+
 class Config(BaseModel):
     app_api_key = CharField()
     messaging_api_key = CharField()
 
-class User(BaseModel):
+class User(Routed, BaseModel):
     name = CharField()
     description = CharField(default='')
     email = CharField(default='')
     username = CharField(default='')
     password = CharField(default='')
 
+    # passwords.Passwords that hashes new passwords and verifies stored ones.
+    passwords = Passwords()
+
     @classmethod
     def crypt_password(cls, username, password):
-        encrypted_password = crypt(password)
-        logging.debug('password={}, encrypted_password={}'.format(password, encrypted_password))
+        encrypted_password = cls.passwords.hash(password)
         return encrypted_password
 
+    def check_password(self, password):
+        return User.passwords.verify(password, self.password)
+
+    def rehash_password(self, password):
+        """Store password under the current hasher and work factor if the stored hash is outdated."""
+        if not User.passwords.needs_rehash(self.password):
+            return False
+
+        # Not a user-visible change, so leave modified and revision alone.
+        self.password = User.crypt_password(self.username, password)
+        User.update(password=self.password).where(User.id == self.id).execute()
+        logging.info('rehash_password: username=%s', self.username)
+        return True
+
     @classmethod
     def create_user(cls, username, password, **kwargs):
         encrypted_password = User.crypt_password(username, password)
-        logging.debug('get_password: username={}, password={}, encrypted_password={}'.format(username, password, encrypted_password))
+        logging.debug('create_user: username=%s', username)
         return User.create(username=username, password=encrypted_password, **kwargs)
 
     def create_device(self, **kwargs):
@@ -70,6 +163,12 @@ class User(BaseModel):
     def add_group(self, group):
         return UserToGroup.add_user_to_group(group=group, user=self)
 
+    @classmethod
+    def derived_routes(cls, ids):
+        devices = Device.select(Device.id).where(Device.user << ids)
+        subscriptions = Subscription.select(Subscription.id).where(Subscription.user << ids)
+        return (Route.device << devices) | (Route.subscription << subscriptions)
+
     def __str__(self):
         return 'name={}, description={}, email={}, username={}, password={}'.format(self.name, self.description, self.email, self.username, '*' * len(self.password))
 
@@ -82,8 +181,8 @@ class Group(BaseModel):
     def is_owner(self, user):
         return self.owner == user
 
-    def is_member(self, user):
-        return UserToGroup.is_member(group=self, user=user)
+    def is_member(self, user, database=None):
+        return UserToGroup.is_member(group=self, user=user, database=database)
 
     def add_user(self, user):
         return UserToGroup.add_user_to_group(group=self, user=user)
@@ -91,7 +190,7 @@ class Group(BaseModel):
     def __str__(self):
         return 'name={}, description={}, owner_id={}, owner.name={}'.format(self.name, self.description, self.owner_id, self.owner.name)
 
-class Device(BaseModel):
+class Device(Routed, BaseModel):
     name = CharField()
     dev_id = CharField(default='')
     reg_id = CharField(default='')
@@ -100,14 +199,25 @@ class Device(BaseModel):
 
     user = ForeignKeyField(User, related_name='devices')
 
+    route_fields = ('reg_id', 'user')
+
     @property
     def parent_id(self):
-        return self.user.id
+        # The column value, so building a uri doesn't fetch the user.
+        return self.user_id
+
+    @classmethod
+    def derived_routes(cls, ids):
+        return Route.device << ids
+
+    @classmethod
+    def refresh_routes(cls, ids, database):
+        Route.refresh(devices=ids, database=database)
 
     def __str__(self):
         return 'name={}, dev_id={}, reg_id={}, resource={}, type={}, user={}'.format(self.name, self.dev_id, self.reg_id, self.resource, self.type, self.user.name)
 
-class Publication(BaseModel):
+class Publication(Routed, BaseModel):
     topic = CharField()
     description = CharField(default='')
 
@@ -117,7 +227,7 @@ class Publication(BaseModel):
 
     @property
     def parent_id(self):
-        return self.user.id
+        return self.user_id
 
     def is_owner(self, user):
         return self.user == user
@@ -128,16 +238,33 @@ class Publication(BaseModel):
     def can_subscribe(self, user):
         return self.subscribe_group.is_member(user)
 
+    def reg_ids(self):
+        return Route.reg_ids(self)
+
+    @classmethod
+    def derived_routes(cls, ids):
+        return Route.publication << ids
+
     def __str__(self):
         return 'topic={}, description={}, user={}'.format(self.topic, self.description, self.user.name)
 
-class Subscription(BaseModel):
+class Subscription(Routed, BaseModel):
     user = ForeignKeyField(User, related_name='subscriptions')
     publication = ForeignKeyField(Publication, related_name='subscriptions')
 
+    route_fields = ('publication', 'user')
+
     @property
     def parent_id(self):
-        return self.user.id
+        return self.user_id
+
+    @classmethod
+    def derived_routes(cls, ids):
+        return Route.subscription << ids
+
+    @classmethod
+    def refresh_routes(cls, ids, database):
+        Route.refresh(subscriptions=ids, database=database)
 
     def __str__(self):
         return 'user={}, pub={}'.format(self.user.name, self.publication.topic)
@@ -156,7 +283,7 @@ class Message(BaseModel):
 
     @property
     def parent_id(self):
-        return self.user.id
+        return self.user_id
 
     def __str__(self):
         a = ['subject={}, body={}, from_user={}'.format(self.subject, self.body, self.user.name)]
@@ -172,6 +299,71 @@ class Message(BaseModel):
 
         return ', '.join(a)
 
+class Retention(BaseModel):
+    """How long messages are kept before they are archived.
+
+    Scoped to a publication's messages, a user's sent messages, or, with neither set, the default for every user
+    without their own policy. Either limit may be unset.
+    """
+
+    user = ForeignKeyField(User, related_name='retentions', null=True)
+    publication = ForeignKeyField(Publication, related_name='retentions', null=True)
+    max_age_days = IntegerField(null=True)
+    max_count = IntegerField(null=True)
+
+    def __str__(self):
+        return 'user_id={}, publication_id={}, max_age_days={}, max_count={}'.format(self.user_id, self.publication_id, self.max_age_days, self.max_count)
+
+
+class Route(Model):
+    """Where a publication's messages go: one row per subscription and subscribed device with a reg_id.
+
+    Derived from Subscription, Device, User and Publication, whose saves and deletes, bulk queries included, keep
+    the affected rows current (see Routed), so a publication's fan-out is one range scan of the covering
+    (publication, reg_id) index. Not exported; rebuilt with refresh() after an import.
+    """
+
+    class Meta:
+        database = BaseModel._meta.database
+        primary_key = CompositeKey('subscription', 'device')
+        indexes = ((('publication', 'reg_id'), False), )
+
+    publication = ForeignKeyField(Publication, related_name='routes', index=False)
+    subscription = ForeignKeyField(Subscription, related_name='routes', index=False)
+    device = ForeignKeyField(Device, related_name='routes')
+    reg_id = CharField()
+
+    @classmethod
+    def source(cls):
+        # The inner joins skip rows left behind by a deleted user or publication.
+        query = Subscription.select(Subscription.publication, Subscription.id, Device.id, Device.reg_id)
+        query = query.join(Publication).switch(Subscription).join(User).switch(Subscription)
+        return query.join(Device, on=(Device.user == Subscription.user)).where(Device.reg_id != '')
+
+    @classmethod
+    def refresh(cls, subscriptions=None, devices=None, database=None):
+        """Recompute the rows of the subscriptions or devices with these ids, or every row."""
+        database = database or cls._meta.database
+        query = cls.source()
+        delete = cls.delete()
+        if subscriptions is not None:
+            query = query.where(Subscription.id << subscriptions)
+            delete = delete.where(cls.subscription << subscriptions)
+        if devices is not None:
+            query = query.where(Device.id << devices)
+            delete = delete.where(cls.device << devices)
+
+        with database.atomic():
+            on(delete, database).execute()
+            on(cls.insert_from([cls.publication, cls.subscription, cls.device, cls.reg_id], query), database).execute()
+
+    @classmethod
+    def reg_ids(cls, publication):
+        query = cls.select(cls.reg_id).where(cls.publication == publication).distinct()
+        return [reg_id for (reg_id, ) in query.tuples()]
+
+    def __str__(self):
+        return 'publication_id={}, subscription_id={}, device_id={}, reg_id={}'.format(self.publication_id, self.subscription_id, self.device_id, self.reg_id)
 
 class UserToGroup(BaseModel):
     """A simple "through" table for many-to-many relationship."""
@@ -185,15 +377,17 @@ class UserToGroup(BaseModel):
     @classmethod
     def add_user_to_group(cls, group, user):
         if UserToGroup.is_member(group=group, user=user):
-            logging.error('User already member of group: group={}, user={}'.format(group, user))
+            logging.error('User already member of group: group=%s, user=%s', group, user)
             return False
 
         return UserToGroup.create(group=group, user=user)
 
     @classmethod
-    def is_member(cls, group, user):
-        logging.debug('group={}, user={}'.format(group, user))
+    def is_member(cls, group, user, database=None):
+        logging.debug('group=%s, user=%s', group, user)
         query = UserToGroup.select().where(UserToGroup.user == user, UserToGroup.group == group)
+        if database:
+            on(query, database)
         if len(query) == 0:
             return False
         elif len(query) == 1:
@@ -210,13 +404,15 @@ class TestModel(unittest.TestCase):
         self.db = SqliteDatabase('peewee.db')
         self.db.connect()
 
-        self.db.create_tables([Device, Group, User, UserToGroup, Publication], safe=True)
+        self.db.create_tables([Device, Group, User, UserToGroup, Publication, Subscription, Route], safe=True)
 
         Device.delete().execute()
         Group.delete().execute()
         User.delete().execute()
         UserToGroup.delete().execute()
         Publication.delete().execute()
+        Subscription.delete().execute()
+        Route.delete().execute()
 
         self.user0 = User.create_user(name='user0name', username='user0username', password='user0password')
         self.user0.create_device(name='device0name', resource='device0resource', type='device0type', dev_id='device0id', reg_id='device0regid')
@@ -270,6 +466,103 @@ class TestModel(unittest.TestCase):
         reg_ids = [d.reg_id for d in devices]
         self.assertEqual(reg_ids, ['device0regid'])
 
+    def test_routes(self):
+        self.assertEqual(self.pub0.reg_ids(), [])
+
+        subscription = Subscription.create(user=self.user0, publication=self.pub0)
+        Subscription.create(user=self.user1, publication=self.pub0)
+        self.assertEqual(self.pub0.reg_ids(), ['device0regid'])
+
+        device = self.user1.create_device(name='device2name', reg_id='device2regid')
+        self.assertEqual(sorted(self.pub0.reg_ids()), ['device0regid', 'device2regid'])
+
+        device.reg_id = 'device2regid2'
+        device.save()
+        self.assertEqual(sorted(self.pub0.reg_ids()), ['device0regid', 'device2regid2'])
+
+        subscription.delete_instance()
+        self.assertEqual(self.pub0.reg_ids(), ['device2regid2'])
+
+        device.delete_instance()
+        self.assertEqual(self.pub0.reg_ids(), [])
+
+        Route.delete().execute()
+        Subscription.create(user=self.user0, publication=self.pub0)
+        Route.delete().execute()
+        Route.refresh()
+        self.assertEqual(self.pub0.reg_ids(), ['device0regid'])
+
+    def test_routes_bulk(self):
+        pub1 = Publication.create(user=self.user1, topic='pub1topic', publish_group=self.group2, subscribe_group=self.group2)
+        Subscription.create(user=self.user0, publication=self.pub0)
+        subscription = Subscription.create(user=self.user1, publication=self.pub0)
+        self.user1.create_device(name='device2name', reg_id='device2regid')
+        self.assertEqual(sorted(self.pub0.reg_ids()), ['device0regid', 'device2regid'])
+
+        Device.update(reg_id='device2regid2').where(Device.user == self.user1).execute()
+        self.assertEqual(sorted(self.pub0.reg_ids()), ['device0regid', 'device2regid2'])
+
+        Subscription.update(publication=pub1).where(Subscription.id == subscription.id).execute()
+        self.assertEqual(self.pub0.reg_ids(), ['device0regid'])
+        self.assertEqual(pub1.reg_ids(), ['device2regid2'])
+
+        Device.delete().where(Device.user == self.user0).execute()
+        self.assertEqual(self.pub0.reg_ids(), [])
+
+        pub1.delete_instance()
+        self.assertEqual(Route.select().count(), 0)
+
+    def test_routes_unchanged(self):
+        Subscription.create(user=self.user0, publication=self.pub0)
+        device = Device.get(Device.user == self.user0)
+
+        # Cleared by hand, so a refresh would show up as the route coming back.
+        Route.delete().execute()
+        device.name = 'device0name2'
+        device.save()
+        Device.update(reg_id='device0regid').where(Device.id == device.id).execute()
+        self.assertEqual(self.pub0.reg_ids(), [])
+
+        device.reg_id = 'device0regid2'
+        device.save()
+        self.assertEqual(self.pub0.reg_ids(), ['device0regid2'])
+
+    def test_routes_deleted_user(self):
+        Subscription.create(user=self.user0, publication=self.pub0)
+        self.assertEqual(self.pub0.reg_ids(), ['device0regid'])
+
+        # Not recursive, so the user's device and subscription are left behind without routes.
+        self.user0.delete_instance()
+        self.assertEqual(self.pub0.reg_ids(), [])
+
+        Route.refresh()
+        self.assertEqual(self.pub0.reg_ids(), [])
+
+    def test_routes_plan(self):
+        query = Route.select(Route.reg_id).where(Route.publication == self.pub0).distinct()
+        (sql, params) = query.sql()
+        plan = ' '.join(str(row) for row in self.db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall())
+        self.assertIn('COVERING INDEX', plan)
+
+    def test_check_password(self):
+        self.assertTrue(self.user0.check_password('user0password'))
+        self.assertFalse(self.user0.check_password('user1password'))
+
+    def test_rehash_password(self):
+        self.assertFalse(self.user0.rehash_password('user0password'))
+
+        passwords = User.passwords
+        User.passwords = Passwords(default='pbkdf2_sha256', iterations=1000)
+        try:
+            self.assertTrue(self.user0.rehash_password('user0password'))
+
+            o = User.get(User.id == self.user0.id)
+            self.assertTrue(o.password.startswith('$pbkdf2-sha256$1000$'))
+            self.assertTrue(o.check_password('user0password'))
+            self.assertEqual(o.revision, self.user0.revision)
+        finally:
+            User.passwords = passwords
+
 ALL_MODELS = \
 [
     Config,
@@ -277,6 +570,8 @@ ALL_MODELS = \
     Group,
     Message,
     Publication,
+    Retention,
+    Route,
     Subscription,
     User,
     UserToGroup,
@@ -0,0 +1,206 @@
+#!venv/bin/python
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import unittest
+
+from concurrent.futures import ProcessPoolExecutor
+
+from pbkdf2 import crypt
+
+class Hasher:
+    """One password hashing scheme; the hashes it writes start with its prefix, which also records the work factor."""
+
+    name = None
+    prefix = None
+    default_iterations = None
+
+    def __init__(self, iterations=None):
+        self.iterations = iterations or self.default_iterations
+
+    def identify(self, encoded):
+        return encoded.startswith(self.prefix)
+
+    def encode(self, password):
+        raise NotImplementedError
+
+    def verify(self, password, encoded):
+        raise NotImplementedError
+
+    def iterations_of(self, encoded):
+        raise NotImplementedError
+
+class P5k2Hasher(Hasher):
+    """The pbkdf2 module's crypt(): PBKDF2-HMAC-SHA1 in pure Python, with the iteration count in hex."""
+
+    name = 'p5k2'
+    prefix = '$p5k2$'
+    default_iterations = 400
+
+    def encode(self, password):
+        # crypt() leaves the count out of the hash when it is the default.
+        return crypt(password, iterations=self.iterations)
+
+    def verify(self, password, encoded):
+        return hmac.compare_digest(crypt(password, encoded), encoded)
+
+    def iterations_of(self, encoded):
+        iterations = encoded.split('$')[2]
+        return int(iterations, 16) if iterations else self.default_iterations
+
+class Pbkdf2Sha256Hasher(Hasher):
+    """PBKDF2-HMAC-SHA256 from hashlib: $pbkdf2-sha256$<iterations>$<salt>$<hash>."""
+
+    name = 'pbkdf2_sha256'
+    prefix = '$pbkdf2-sha256$'
+    default_iterations = 100000
+
+    def b64(self, data):
+        return base64.b64encode(data, b'./').decode('ascii').rstrip('=')
+
+    def encode(self, password, salt=None, iterations=None):
+        salt = salt or self.b64(os.urandom(12))
+        iterations = iterations or self.iterations
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('ascii'), iterations)
+        return '{}{}${}${}'.format(self.prefix, iterations, salt, self.b64(digest))
+
+    def verify(self, password, encoded):
+        (iterations, salt) = encoded[len(self.prefix):].split('$')[:2]
+        return hmac.compare_digest(self.encode(password, salt=salt, iterations=int(iterations)), encoded)
+
+    def iterations_of(self, encoded):
+        return int(encoded[len(self.prefix):].split('$')[0])
+
+HASHERS = [P5k2Hasher, Pbkdf2Sha256Hasher]
+
+DEFAULT_HASHER = P5k2Hasher.name
+
+# Run in a worker process, so they must be importable module-level functions.
+def _encode(hasher, password):
+    return hasher.encode(password)
+
+def _verify(hasher, password, encoded):
+    return hasher.verify(password, encoded)
+
+class Passwords:
+    """Registry of hashers: new hashes use the default one, existing hashes are verified by whichever wrote them.
+
+    A hash written by another hasher, or with a different work factor, needs rehashing; callers redo it with
+    the plain password after a successful verify. With workers, hashing runs in a process pool so the pure
+    Python hashers don't hold the GIL in request threads.
+    """
+
+    def __init__(self, default=DEFAULT_HASHER, iterations=None, hashers=HASHERS, workers=0):
+        self.hashers = {}
+        for hasher_cls in hashers:
+            self.register(hasher_cls(iterations=iterations if hasher_cls.name == default else None))
+
+        if default not in self.hashers:
+            raise ValueError('Unknown password hasher: {}'.format(default))
+        self.default = self.hashers[default]
+
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Hasher from PASSWORD_HASHER, work factor from PASSWORD_ITERATIONS, pool size from PASSWORD_HASH_WORKERS."""
+        iterations = os.environ.get('PASSWORD_ITERATIONS')
+        return cls(
+            default=os.environ.get('PASSWORD_HASHER', DEFAULT_HASHER),
+            iterations=int(iterations) if iterations else None,
+            workers=int(os.environ.get('PASSWORD_HASH_WORKERS', 0)))
+
+    def register(self, hasher):
+        self.hashers[hasher.name] = hasher
+
+    def hasher_for(self, encoded):
+        return next((h for h in self.hashers.values() if encoded and h.identify(encoded)), None)
+
+    def call(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        with self._lock:
+            # A pool inherited across fork() has no live workers in the child.
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            executor = self._executor
+
+        return executor.submit(fn, *args).result()
+
+    def hash(self, password):
+        return self.call(_encode, self.default, password)
+
+    def verify(self, password, encoded):
+        hasher = self.hasher_for(encoded)
+        if hasher is None:
+            logging.warning('verify: unknown password hash scheme')
+            return False
+
+        try:
+            return self.call(_verify, hasher, password, encoded)
+        except ValueError:
+            logging.warning('verify: malformed password hash: hasher=%s', hasher.name)
+            return False
+
+    def needs_rehash(self, encoded):
+        if not self.default.identify(encoded):
+            return True
+
+        return self.default.iterations_of(encoded) != self.default.iterations
+
+class TestPasswords(unittest.TestCase):
+    def test_p5k2(self):
+        passwords = Passwords()
+        encoded = passwords.hash('secret')
+
+        self.assertTrue(encoded.startswith('$p5k2$$'))
+        self.assertTrue(passwords.verify('secret', encoded))
+        self.assertFalse(passwords.verify('wrong', encoded))
+        self.assertFalse(passwords.needs_rehash(encoded))
+
+    def test_pbkdf2_sha256(self):
+        passwords = Passwords(default='pbkdf2_sha256', iterations=1000)
+        encoded = passwords.hash('secret')
+
+        self.assertTrue(encoded.startswith('$pbkdf2-sha256$1000$'))
+        self.assertTrue(passwords.verify('secret', encoded))
+        self.assertFalse(passwords.verify('wrong', encoded))
+        self.assertNotEqual(passwords.hash('secret'), encoded)
+
+    def test_needs_rehash(self):
+        old = Passwords().hash('secret')
+
+        passwords = Passwords(default='pbkdf2_sha256', iterations=1000)
+        self.assertTrue(passwords.verify('secret', old))
+        self.assertTrue(passwords.needs_rehash(old))
+
+        self.assertTrue(Passwords(iterations=1).needs_rehash(old))
+        self.assertFalse(Passwords(iterations=400).needs_rehash(old))
+        self.assertTrue(Passwords(default='pbkdf2_sha256', iterations=2000).needs_rehash(passwords.hash('secret')))
+
+    def test_unknown(self):
+        passwords = Passwords()
+        self.assertFalse(passwords.verify('secret', 'secret'))
+        self.assertFalse(passwords.verify('secret', ''))
+        self.assertFalse(passwords.verify('secret', '$p5k2$zz$salt$hash'))
+        self.assertTrue(passwords.needs_rehash('secret'))
+        self.assertRaises(ValueError, Passwords, default='md5')
+
+    def test_workers(self):
+        passwords = Passwords(default='pbkdf2_sha256', iterations=1000, workers=1)
+        encoded = passwords.hash('secret')
+
+        self.assertTrue(passwords.verify('secret', encoded))
+        self.assertEqual(passwords._pid, os.getpid())
+        passwords._executor.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+#!venv/bin/python
+"""Prefork entry point.
+
+The master creates the app and builds its endpoints once, binds the listening
+socket and forks shared-nothing workers that inherit both (copy-on-write).
+Each worker handles one request at a time on its own database connections, so
+CPU-bound work (PBKDF2, serialization) scales with cores instead of sharing one
+GIL.
+
+    ./prefork.py --host 0.0.0.0 --port 8000 --workers 8 --max-requests 1000
+
+Dead workers are replaced, and workers exit after --max-requests (plus a
+little jitter) so they are recycled before they grow. SIGTERM/SIGINT let each
+worker finish its current request before the master exits.
+"""
+import argparse
+import logging
+import os
+import random
+import signal
+import socket
+import time
+import unittest
+import urllib.request
+
+from werkzeug.serving import make_server
+from werkzeug.serving import WSGIRequestHandler
+
+import log
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+DEFAULT_MAX_REQUESTS = 1000
+DEFAULT_MAX_REQUESTS_JITTER = 50
+
+def reopen_databases(databases):
+    """Drop any inherited connection so the next query opens one owned by this process."""
+    for database in databases:
+        if not database.is_closed():
+            database.close()
+
+class RequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        # The app writes its own access log.
+        pass
+
+class Worker:
+    def __init__(self, app, sock, max_requests, databases=()):
+        self.app = app
+        self.sock = sock
+        self.max_requests = max_requests
+        self.databases = databases
+        self.requests = 0
+        self.running = True
+
+    def stop(self, signum, frame):
+        self.running = False
+
+    def count(self, environ, start_response):
+        self.requests += 1
+        return self.app(environ, start_response)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        reopen_databases(self.databases)
+
+        host, port = self.sock.getsockname()[:2]
+        server = make_server(host, port, self.count, request_handler=RequestHandler, fd=self.sock.fileno())
+        server.timeout = 1
+
+        while self.running and self.requests < self.max_requests:
+            server.handle_request()
+
+        logging.info('worker exiting: pid=%d, requests=%d', os.getpid(), self.requests)
+
+class Arbiter:
+    """Forks and supervises prefork workers sharing one listening socket."""
+
+    def __init__(self, app, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None, max_requests=DEFAULT_MAX_REQUESTS,
+            max_requests_jitter=DEFAULT_MAX_REQUESTS_JITTER, databases=()):
+        self.app = app
+        self.address = (host, port)
+        self.num_workers = workers or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.databases = databases
+        self.workers = set()
+        self.sock = None
+        self.running = False
+
+    def bind(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen(socket.SOMAXCONN)
+        self.address = self.sock.getsockname()
+        return self.address
+
+    def spawn(self):
+        # Never fork with an open connection; sqlite handles must not be shared between processes.
+        reopen_databases(self.databases)
+
+        max_requests = self.max_requests + random.randint(0, self.max_requests_jitter)
+
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return pid
+
+        status = 0
+        try:
+            Worker(self.app, self.sock, max_requests, self.databases).run()
+        except:
+            logging.exception('worker failed')
+            status = 1
+        finally:
+            log.shutdown()
+            os._exit(status)
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.workers.discard(pid)
+
+    def run(self):
+        if not self.sock:
+            self.bind()
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        logging.info('listening: address=%s, workers=%d, max_requests=%d', self.address, self.num_workers, self.max_requests)
+
+        self.running = True
+        for _ in range(self.num_workers):
+            self.spawn()
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            self.workers.discard(pid)
+            if self.running:
+                logging.info('respawning worker: pid=%d, status=%d', pid, status)
+                if status:
+                    # Don't spin if workers crash on startup.
+                    time.sleep(1)
+                self.spawn()
+
+        self.sock.close()
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Serve the REST API with prefork workers.')
+    parser.add_argument('--host', default=os.environ.get('SERVE_HOST', DEFAULT_HOST))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVE_PORT', DEFAULT_PORT)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SERVE_WORKERS', 0)) or None, help='processes (default: one per core)')
+    parser.add_argument('--max-requests', type=int, default=int(os.environ.get('SERVE_MAX_REQUESTS', DEFAULT_MAX_REQUESTS)), help='requests before a worker is recycled')
+    return parser.parse_args(args)
+
+def main(args=None):
+    args = parse_args(args)
+
+    from app import create_app
+    from app import database
+    from app import limiter
+    from app import router
+    from app import shards
+
+    # Build the endpoints here, once, so the workers share them copy-on-write.
+    Arbiter(create_app(warm=True), host=args.host, port=args.port, workers=args.workers, max_requests=args.max_requests,
+        databases=[database.database] + router.databases + shards.shards + limiter.databases).run()
+
+def pid_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode('ascii')]
+
+class TestArbiter(unittest.TestCase):
+    def setUp(self):
+        self.pid = None
+
+    def start(self, workers=2, max_requests=2):
+        self.arbiter = Arbiter(pid_app, port=0, workers=workers, max_requests=max_requests, max_requests_jitter=0)
+        self.host, self.port = self.arbiter.bind()
+
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                self.arbiter.run()
+            finally:
+                os._exit(0)
+
+    def tearDown(self):
+        if self.pid:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+            self.arbiter.sock.close()
+
+    def get(self):
+        with urllib.request.urlopen('http://{}:{}/'.format(self.host, self.port), timeout=5) as response:
+            return int(response.read())
+
+    def exists(self, pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def test_recycle(self):
+        self.start()
+        pids = [self.get() for _ in range(8)]
+
+        # 8 requests over workers that each serve 2 means at least 4 distinct processes.
+        self.assertGreaterEqual(len(set(pids)), 4)
+        self.assertNotIn(self.pid, pids)
+
+    def test_respawn(self):
+        # One worker that is never recycled, so a new pid can only be a replacement for the killed one.
+        self.start(workers=1, max_requests=1000)
+        pid = self.get()
+        self.assertEqual(self.get(), pid)
+
+        os.kill(pid, signal.SIGKILL)
+        deadline = time.monotonic() + 5
+        while self.exists(pid):
+            self.assertLess(time.monotonic(), deadline, 'killed worker was not reaped')
+            time.sleep(0.05)
+
+        # get() times out after 5 seconds if no worker takes over the socket.
+        respawned = self.get()
+        self.assertNotIn(respawned, (pid, self.pid))
+        self.assertEqual(self.get(), respawned)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!venv/bin/python
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from collections import namedtuple
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g
+from flask import jsonify
+from flask import make_response
+from flask import request
+
+from peewee import SqliteDatabase
+
+from playhouse.db_url import connect
+
+# capacity requests per period seconds, in bursts of up to capacity.
+Rate = namedtuple('Rate', ['capacity', 'period'])
+
+DEVICE_HEADER = 'X-Device-Id'
+
+def parse_rate(rate):
+    """'<capacity>/<period seconds>', e.g. '60/60'; Rate and None pass through."""
+    if rate is None or isinstance(rate, Rate):
+        return rate
+
+    (capacity, period) = rate.split('/')
+    return Rate(int(capacity), float(period))
+
+def current_device():
+    return request.headers.get(DEVICE_HEADER) or request.remote_addr
+
+# Buckets are kept in GCRA form: a token bucket is fully described by the time it will be full again (its
+# "theoretical arrival time"), so each key costs one float, and a key whose time has passed is a full bucket
+# that can be dropped without changing any decision.
+
+class MemoryBuckets:
+    """Per-process buckets in least-recently-used order, so idle (full) buckets are evicted from the front."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._tats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tats)
+
+    def take(self, key, rate):
+        """Seconds to wait before key may try again, or 0 after taking a token."""
+        interval = rate.period / rate.capacity
+        now = self.clock()
+
+        with self._lock:
+            while self._tats:
+                (oldest, tat) = next(iter(self._tats.items()))
+                if tat > now:
+                    break
+                del self._tats[oldest]
+
+            tat = max(self._tats.get(key, now), now)
+            wait = tat + interval - rate.period - now
+            if wait > 0:
+                return wait
+
+            self._tats[key] = tat + interval
+            self._tats.move_to_end(key)
+            return 0
+
+class SqliteBuckets:
+    """Buckets in an SQLite table shared by every process on the host; each take is one atomic UPDATE."""
+
+    table = 'ratelimit'
+
+    # Delete full buckets every this many takes.
+    evict_every = 1000
+
+    def __init__(self, database, clock=time.time):
+        self.database = database
+        self.clock = clock
+        self._takes = 0
+        self._created = False
+
+    def ensure(self):
+        # Not in __init__: that runs at import, and a connection opened in a prefork master would be shared by
+        # every worker.
+        if not self._created:
+            self.database.execute_sql('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, tat REAL NOT NULL)'.format(self.table))
+            self._created = True
+
+    def __len__(self):
+        self.ensure()
+        return self.database.execute_sql('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+
+    def take(self, key, rate):
+        interval = rate.period / rate.capacity
+        now = self.clock()
+        key = '|'.join(str(k) for k in key)
+        self.ensure()
+
+        self._takes += 1
+        if self._takes % self.evict_every == 0:
+            self.database.execute_sql('DELETE FROM {} WHERE tat <= ?'.format(self.table), (now, ))
+
+        self.database.execute_sql('INSERT OR IGNORE INTO {} (key, tat) VALUES (?, ?)'.format(self.table), (key, now))
+        cursor = self.database.execute_sql('UPDATE {} SET tat = MAX(tat, ?) + ? WHERE key = ? AND MAX(tat, ?) + ? - ? <= ?'.format(self.table), (now, interval, key, now, interval, rate.period, now))
+        if cursor.rowcount:
+            return 0
+
+        (tat, ) = self.database.execute_sql('SELECT tat FROM {} WHERE key = ?'.format(self.table), (key, )).fetchone()
+        return max(tat, now) + interval - rate.period - now
+
+class RateLimiter:
+    """Token buckets per (user, endpoint, device), applied after authentication.
+
+    Endpoints get their rate from set_rate, normally through View.add(rate=...), else the default rate; without
+    either they are not limited. The device is the X-Device-Id header, else the remote address.
+    """
+
+    def __init__(self, buckets=None, default=None, device=current_device):
+        self.buckets = buckets if buckets is not None else MemoryBuckets()
+        self.default = parse_rate(default)
+        self.device = device
+        self.rates = {}
+
+    @classmethod
+    def from_env(cls):
+        """Default rate from RATE_LIMIT_DEFAULT; buckets shared through RATE_LIMIT_DATABASE (a database URL) if set."""
+        url = os.environ.get('RATE_LIMIT_DATABASE')
+        buckets = SqliteBuckets(connect(url)) if url else MemoryBuckets()
+        return cls(buckets=buckets, default=os.environ.get('RATE_LIMIT_DEFAULT') or None)
+
+    @property
+    def databases(self):
+        """Databases the buckets are kept in, for closing before fork()."""
+        database = getattr(self.buckets, 'database', None)
+        return [database] if database is not None else []
+
+    def set_rate(self, endpoint, rate):
+        self.rates[endpoint] = parse_rate(rate)
+
+    def rate_for(self, endpoint):
+        return self.rates.get(endpoint, self.default)
+
+    def check(self):
+        """Seconds the current request must wait, or 0 if it may proceed."""
+        rate = self.rate_for(request.endpoint)
+        if rate is None:
+            return 0
+
+        user = getattr(g, 'current_user', None)
+        key = (getattr(user, 'id', None), request.endpoint, self.device())
+        return self.buckets.take(key, rate)
+
+    def limit(self, f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            wait = self.check()
+            if wait:
+                logging.info('rate limited: endpoint=%s, user=%s, wait=%.1f', request.endpoint, getattr(g.get('current_user'), 'id', None), wait)
+                response = make_response(jsonify({'error': 'Too many requests'}), 429)
+                response.headers['Retry-After'] = str(max(1, int(math.ceil(wait))))
+                return response
+
+            return f(*args, **kwargs)
+        return decorated
+
+class TestBuckets(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.rate = Rate(2, 10)
+
+    def take_all(self, buckets, key=('u', 'e', 'd')):
+        return [buckets.take(key, self.rate) for _ in range(3)]
+
+    def check_buckets(self, buckets):
+        self.assertEqual(self.take_all(buckets), [0, 0, 5])
+
+        # Other keys have their own buckets.
+        self.assertEqual(buckets.take(('u', 'e', 'other'), self.rate), 0)
+
+        # One token comes back every period / capacity seconds.
+        self.now += 5
+        self.assertEqual(self.take_all(buckets), [0, 5, 5])
+
+        self.now += 100
+        self.assertEqual(self.take_all(buckets), [0, 0, 5])
+
+    def test_memory(self):
+        buckets = MemoryBuckets(clock=lambda: self.now)
+        self.check_buckets(buckets)
+
+    def test_memory_eviction(self):
+        buckets = MemoryBuckets(clock=lambda: self.now)
+        for i in range(100):
+            buckets.take(('u', 'e', i), self.rate)
+        self.assertEqual(len(buckets), 100)
+
+        self.now += 5
+        buckets.take(('u', 'e', 'new'), self.rate)
+        self.assertEqual(len(buckets), 1)
+
+    def test_sqlite(self):
+        dir = tempfile.mkdtemp()
+        try:
+            database = SqliteDatabase(os.path.join(dir, 'ratelimit.db'))
+            buckets = SqliteBuckets(database, clock=lambda: self.now)
+            self.assertTrue(database.is_closed())
+            self.check_buckets(buckets)
+
+            # A second process sees the same buckets.
+            other = SqliteBuckets(SqliteDatabase(os.path.join(dir, 'ratelimit.db')), clock=lambda: self.now)
+            self.assertEqual(other.take(('u', 'e', 'd'), self.rate), 5)
+
+            buckets.evict_every = 1
+            self.now += 100
+            buckets.take(('u', 'e', 'd'), self.rate)
+            self.assertEqual(len(buckets), 1)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_databases(self):
+        self.assertEqual(RateLimiter().databases, [])
+
+        database = SqliteDatabase(':memory:')
+        self.assertEqual(RateLimiter(buckets=SqliteBuckets(database)).databases, [database])
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('60/30'), Rate(60, 30.0))
+        self.assertEqual(parse_rate(None), None)
+
+if __name__ == '__main__':
+    unittest.main()
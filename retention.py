@@ -0,0 +1,220 @@
+#!venv/bin/python
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from peewee import DateTimeField
+from peewee import SqliteDatabase
+from peewee import Using
+
+try:
+    import fcntl
+except ImportError:
+    # Unix only; elsewhere appends are not locked against concurrent archive runs.
+    fcntl = None
+
+from db import on
+from model import Message
+from model import Retention
+
+DEFAULT_BATCH_SIZE = 500
+
+class Archive:
+    """Append-only, gzip-compressed NDJSON files of archived rows, one file per sending user.
+
+    Each append adds a complete gzip member, so files can be extended without rewriting them. Reads scan
+    files and are meant for occasional lookups, not the hot path.
+    """
+
+    key = 'user'
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.environ.get('MESSAGE_ARCHIVE_DIR', 'archive'))
+
+    def directory(self, model_cls):
+        return os.path.join(self.path, model_cls._meta.db_table)
+
+    def path_for(self, model_cls, key):
+        return os.path.join(self.directory(model_cls), '{}-{}.ndjson.gz'.format(self.key, key))
+
+    def append(self, model_cls, rows):
+        os.makedirs(self.directory(model_cls), exist_ok=True)
+
+        by_key = {}
+        for row in rows:
+            by_key.setdefault(row[self.key], []).append(row)
+
+        for (key, key_rows) in by_key.items():
+            lines = ''.join(json.dumps(row, default=datetime.datetime.isoformat) + '\n' for row in key_rows)
+
+            with open(self.path_for(model_cls, key), 'ab') as raw:
+                if fcntl:
+                    fcntl.flock(raw, fcntl.LOCK_EX)
+                with gzip.GzipFile(fileobj=raw, mode='ab') as f:
+                    f.write(lines.encode('utf-8'))
+                raw.flush()
+                os.fsync(raw.fileno())
+
+    def rows(self, model_cls, key=None):
+        if key is None:
+            directory = self.directory(model_cls)
+            paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))] if os.path.isdir(directory) else []
+        else:
+            paths = [self.path_for(model_cls, int(key))]
+
+        dates = [name for (name, field) in model_cls._meta.fields.items() if isinstance(field, DateTimeField)]
+
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    row = json.loads(line)
+                    for name in dates:
+                        if row.get(name):
+                            row[name] = datetime.datetime.fromisoformat(row[name])
+                    yield row
+
+    def read(self, model_cls, field=None, value=None, id=None):
+        """Archived instances, newest first, optionally filtered by a foreign key value and/or id."""
+        key = value if field is not None and field.name == self.key else None
+
+        found = {}
+        for row in self.rows(model_cls, key=key):
+            if field is not None and row.get(field.name) != int(value):
+                continue
+            if id is not None and row['id'] != int(id):
+                continue
+
+            # A batch may be archived twice if a run dies between archiving and deleting it.
+            found[row['id']] = row
+
+        return sorted((model_cls(**row) for row in found.values()), key=lambda o: o.modified, reverse=True)
+
+def expired_ids(database, scope, max_age_days=None, max_count=None, now=None, limit=DEFAULT_BATCH_SIZE):
+    ids = set()
+
+    if max_age_days is not None:
+        cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days=max_age_days)
+        query = Message.select(Message.id).where(scope & (Message.modified < cutoff)).limit(limit)
+        ids.update(row[0] for row in on(query, database).tuples())
+
+    if max_count is not None:
+        query = Message.select(Message.id).where(scope).order_by(Message.modified.desc()).limit(limit).offset(max_count)
+        ids.update(row[0] for row in on(query, database).tuples())
+
+    return sorted(ids)[:limit]
+
+def archive_batch(database, archive, ids, search_index=None):
+    rows = list(on(Message.select().where(Message.id << ids), database).dicts())
+    archive.append(Message, rows)
+
+    with database.atomic():
+        on(Message.delete().where(Message.id << ids), database).execute()
+        if search_index:
+            search_index.remove(database, Message, ids)
+
+    return len(rows)
+
+def scopes(database, policies):
+    """(scope, policy) pairs; the default policy expands to one scope per sender without a user policy."""
+    users = {p.user_id for p in policies if p.user_id}
+
+    for policy in policies:
+        if policy.publication_id:
+            yield (Message.to_publication == policy.publication_id, policy)
+        elif policy.user_id:
+            yield (Message.user == policy.user_id, policy)
+        else:
+            senders = on(Message.select(Message.user).distinct(), database).tuples()
+            for (user_id, ) in senders:
+                if user_id not in users:
+                    yield (Message.user == user_id, policy)
+
+def apply_policies(databases, archive, policies=None, now=None, batch_size=DEFAULT_BATCH_SIZE, search_index=None):
+    """Archive, then delete, every message outside its retention policy, batch_size rows per transaction."""
+    if policies is None:
+        policies = list(Retention.select())
+
+    archived = 0
+    for database in databases:
+        for (scope, policy) in list(scopes(database, policies)):
+            while True:
+                ids = expired_ids(database, scope, max_age_days=policy.max_age_days, max_count=policy.max_count, now=now, limit=batch_size)
+                if not ids:
+                    break
+                archived += archive_batch(database, archive, ids, search_index=search_index)
+
+        logging.info('archived: database=%s, total=%d', database.database, archived)
+
+    return archived
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.archive = Archive(os.path.join(self.dir, 'archive'))
+
+        self.db = SqliteDatabase(os.path.join(self.dir, 'messages.db'))
+        with Using(self.db, [Message], with_transaction=False):
+            Message.create_table()
+
+        self.now = datetime.datetime(2026, 1, 31)
+        for (i, (user, publication)) in enumerate([(1, None), (1, None), (1, 5), (2, None), (2, 5), (3, None)]):
+            modified = self.now - datetime.timedelta(days=10 - i)
+            query = Message.insert(user=user, to_publication=publication, subject=str(i), created=modified, modified=modified)
+            on(query, self.db).execute()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def subjects(self):
+        return sorted(row[0] for row in on(Message.select(Message.subject), self.db).tuples())
+
+    def apply(self, *policies):
+        return apply_policies([self.db], self.archive, policies=list(policies), now=self.now, batch_size=1)
+
+    def test_max_age(self):
+        self.assertEqual(self.apply(Retention(max_age_days=7)), 3)
+        self.assertEqual(self.subjects(), ['3', '4', '5'])
+        self.assertEqual(self.apply(Retention(max_age_days=7)), 0)
+
+    def test_max_count_per_user(self):
+        self.assertEqual(self.apply(Retention(max_count=1)), 3)
+        self.assertEqual(self.subjects(), ['2', '4', '5'])
+
+    def test_user_overrides_default(self):
+        self.apply(Retention(max_count=1), Retention(user=1, max_count=2))
+        self.assertEqual(self.subjects(), ['1', '2', '4', '5'])
+
+    def test_publication(self):
+        self.apply(Retention(publication=5, max_count=1))
+        self.assertEqual(self.subjects(), ['0', '1', '3', '4', '5'])
+
+    def test_read(self):
+        self.apply(Retention(max_count=1))
+
+        self.assertEqual([o.subject for o in self.archive.read(Message)], ['3', '1', '0'])
+        self.assertEqual([o.subject for o in self.archive.read(Message, field=Message.user, value='1')], ['1', '0'])
+        self.assertEqual([o.subject for o in self.archive.read(Message, field=Message.to_publication, value=5)], [])
+        self.assertEqual(self.archive.read(Message, id=1)[0].modified, self.now - datetime.timedelta(days=10))
+
+    def test_duplicates(self):
+        rows = list(on(Message.select().where(Message.user == 3), self.db).dicts())
+        self.archive.append(Message, rows)
+        self.archive.append(Message, rows)
+
+        self.assertEqual(len(self.archive.read(Message)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+#!venv/bin/python
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from flask import has_request_context
+from flask import request
+
+from peewee import CharField
+from peewee import Model
+from peewee import SqliteDatabase
+
+from playhouse.db_url import connect
+
+from db import on
+
+DEFAULT_STICKY_SECONDS = 5.0
+
+def current_client():
+    """Stickiness key: the Basic auth username, so it is known before authentication, else the remote address."""
+    if not has_request_context():
+        return None
+
+    if request.authorization and request.authorization.username:
+        return request.authorization.username
+
+    return request.remote_addr
+
+class MemoryWrites:
+    """When each client last wrote, in this process only, so stickiness doesn't carry across prefork or --workers processes."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._written = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._written)
+
+    def add(self, client, seconds):
+        now = self.clock()
+        with self._lock:
+            self._written[client] = now + seconds
+
+            # Keep the map bounded by dropping expired entries once it grows.
+            if len(self._written) > 1024:
+                self._written = {k: v for (k, v) in self._written.items() if v > now}
+
+    def __contains__(self, client):
+        with self._lock:
+            until = self._written.get(client)
+            if until is None:
+                return False
+
+            if until <= self.clock():
+                del self._written[client]
+                return False
+
+        return True
+
+class SqliteWrites:
+    """When each client last wrote, in an SQLite table shared by every process on the host."""
+
+    table = 'sticky'
+
+    # Delete expired rows every this many writes.
+    evict_every = 1000
+
+    def __init__(self, database, clock=time.time):
+        self.database = database
+        self.clock = clock
+        self._adds = 0
+        self._created = False
+
+    def ensure(self):
+        # Not in __init__, so a prefork master doesn't open a connection its workers would share.
+        if not self._created:
+            self.database.execute_sql('CREATE TABLE IF NOT EXISTS {} (client TEXT PRIMARY KEY, until REAL NOT NULL)'.format(self.table))
+            self._created = True
+
+    def __len__(self):
+        self.ensure()
+        return self.database.execute_sql('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+
+    def add(self, client, seconds):
+        now = self.clock()
+        self.ensure()
+
+        self._adds += 1
+        if self._adds % self.evict_every == 0:
+            self.database.execute_sql('DELETE FROM {} WHERE until <= ?'.format(self.table), (now, ))
+
+        self.database.execute_sql('INSERT OR REPLACE INTO {} (client, until) VALUES (?, ?)'.format(self.table), (client, now + seconds))
+
+    def __contains__(self, client):
+        self.ensure()
+        return self.database.execute_sql('SELECT 1 FROM {} WHERE client = ? AND until > ?'.format(self.table), (client, self.clock())).fetchone() is not None
+
+class DatabaseRouter:
+    """Sends SELECTs to a pool of read replicas and everything else to the primary.
+
+    A client that wrote within the last sticky_seconds reads from the primary so it sees its own writes. Writes
+    are remembered in writes: MemoryWrites per process, or SqliteWrites to share them between processes.
+    """
+
+    def __init__(self, primary, replicas=(), sticky_seconds=DEFAULT_STICKY_SECONDS, client=current_client, writes=None):
+        self.primary = primary
+        self.sticky_seconds = sticky_seconds
+        self.client = client
+        self.writes = writes if writes is not None else MemoryWrites()
+
+        self.set_replicas(replicas)
+
+    @classmethod
+    def from_env(cls, primary):
+        """Replicas from DATABASE_REPLICAS (comma-separated database URLs), window from DATABASE_STICKY_SECONDS,
+        writes shared through DATABASE_STICKY_DATABASE (a database URL) if set.
+        """
+        urls = [url.strip() for url in os.environ.get('DATABASE_REPLICAS', '').split(',') if url.strip()]
+        sticky_seconds = float(os.environ.get('DATABASE_STICKY_SECONDS', DEFAULT_STICKY_SECONDS))
+        url = os.environ.get('DATABASE_STICKY_DATABASE')
+        writes = SqliteWrites(connect(url)) if url else MemoryWrites()
+        return cls(primary, replicas=[connect(url) for url in urls], sticky_seconds=sticky_seconds, writes=writes)
+
+    def set_replicas(self, replicas):
+        self.replicas = list(replicas)
+        self._next_replica = itertools.cycle(self.replicas) if self.replicas else None
+
+    @property
+    def databases(self):
+        database = getattr(self.writes, 'database', None)
+        return [self.primary] + self.replicas + ([database] if database is not None else [])
+
+    def is_sticky(self, client):
+        return client is not None and client in self.writes
+
+    def read(self):
+        if not self._next_replica or self.is_sticky(self.client()):
+            return self.primary
+
+        return next(self._next_replica)
+
+    def write(self):
+        client = self.client()
+        if client is not None and self.sticky_seconds > 0:
+            self.writes.add(client, self.sticky_seconds)
+
+        return self.primary
+
+    def route(self, query, primary=False):
+        return on(query, self.primary if primary else self.read())
+
+test_primary = SqliteDatabase(':memory:')
+
+class Item(Model):
+    class Meta:
+        database = test_primary
+
+    name = CharField()
+
+class TestDatabaseRouter(unittest.TestCase):
+    def setUp(self):
+        self.replicas = [SqliteDatabase(':memory:'), SqliteDatabase(':memory:')]
+        for (i, db) in enumerate([test_primary] + self.replicas):
+            db.execute_sql('CREATE TABLE IF NOT EXISTS item (id INTEGER PRIMARY KEY, name VARCHAR(255))')
+            db.execute_sql('DELETE FROM item')
+            db.execute_sql('INSERT INTO item (name) VALUES (?)', ('db{}'.format(i), ))
+
+        self.client = 'alice'
+        self.now = 100.0
+        self.router = DatabaseRouter(test_primary, self.replicas, sticky_seconds=5, client=lambda: self.client, writes=MemoryWrites(clock=lambda: self.now))
+
+    def name(self, primary=False):
+        return self.router.route(Item.select(), primary=primary).get().name
+
+    def test_round_robin(self):
+        self.assertEqual([self.name() for _ in range(4)], ['db1', 'db2', 'db1', 'db2'])
+
+    def test_primary(self):
+        self.assertEqual(self.name(primary=True), 'db0')
+
+    def test_no_replicas(self):
+        self.router = DatabaseRouter(test_primary)
+        self.assertEqual(self.name(), 'db0')
+
+    def test_read_your_writes(self):
+        self.router.write()
+        self.assertEqual(self.name(), 'db0')
+
+        self.client = 'bob'
+        self.assertEqual(self.name(), 'db1')
+
+        self.client = 'alice'
+        self.now += 5
+        self.assertEqual(self.name(), 'db2')
+
+    def test_shared_writes(self):
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'sticky.db')
+            self.router.writes = SqliteWrites(SqliteDatabase(path), clock=lambda: self.now)
+            self.router.write()
+
+            # Another process, with its own connection, reads alice's write from the primary.
+            other = DatabaseRouter(test_primary, self.replicas, client=lambda: self.client, writes=SqliteWrites(SqliteDatabase(path), clock=lambda: self.now))
+            self.assertEqual(other.route(Item.select()).get().name, 'db0')
+
+            self.now += 5
+            self.assertEqual(other.route(Item.select()).get().name, 'db1')
+            self.assertIn(self.router.writes.database, self.router.databases)
+        finally:
+            shutil.rmtree(dir)
+
+    def test_anonymous_not_sticky(self):
+        self.client = None
+        self.router.write()
+        self.assertEqual(self.name(), 'db1')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -57,6 +57,12 @@ class MessageSchema(BaseSchema):
     subject = fields.Str(required=True)
     body = fields.Str(required=True)
 
+class RetentionSchema(BaseSchema):
+    user = fields.Int(attribute='user_id', allow_none=True)
+    publication = fields.Int(attribute='publication_id', allow_none=True)
+    max_age_days = fields.Int(allow_none=True)
+    max_count = fields.Int(allow_none=True)
+
 class TestSchema(unittest.TestCase):
     def setUp(self):
         pass
@@ -0,0 +1,249 @@
+#!venv/bin/python
+import heapq
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from peewee import SqliteDatabase
+from peewee import Using
+
+from db import on
+from model import Message
+from model import Publication
+
+# Per model: kind, code, (title, body, owner) field names. The owner is the user the row is listed under (its
+# uri parent), and the only user besides admins whose routes return it.
+INDEXED = {
+    Message: ('message', 0, ('subject', 'body', 'user')),
+    Publication: ('publication', 1, ('topic', 'description', 'user')),
+}
+
+# rowid = id * ROWID_STRIDE + code, so a row's entry can be replaced without scanning the index.
+ROWID_STRIDE = 16
+
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+# Only this many best matches can be paged through, so a large page can't make every database sort them all.
+MAX_RESULTS = 1000
+
+def batches(model_cls, database, batch_size):
+    """Rows as dicts in id order, batch_size at a time, without holding a cursor open."""
+    last_id = 0
+    while True:
+        query = model_cls.select().where(model_cls.id > last_id).order_by(model_cls.id).limit(batch_size)
+        rows = list(on(query, database).dicts())
+        if not rows:
+            return
+
+        yield rows
+        last_id = rows[-1]['id']
+
+def match_expression(term):
+    """Quote every word so user input is matched literally (all words, any order) instead of parsed as FTS5 syntax."""
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in term.split())
+
+class SearchIndex:
+    """FTS5 index over message subjects/bodies and publication topics/descriptions.
+
+    Each database indexes the rows it holds, so sharded messages are indexed on their shard.
+    """
+
+    table = 'search_index'
+
+    def __init__(self):
+        self._created = set()
+
+    def supports(self, model_cls):
+        return model_cls in INDEXED
+
+    def create_table(self, database):
+        database.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(kind UNINDEXED, ref UNINDEXED, owner UNINDEXED, title, body)'.format(self.table))
+        self._created.add(id(database))
+
+    def ensure(self, database):
+        if id(database) not in self._created:
+            self.create_table(database)
+
+    def rowid(self, model_cls, id):
+        return int(id) * ROWID_STRIDE + INDEXED[model_cls][1]
+
+    def entry(self, model_cls, row):
+        (kind, _, (title, body, owner)) = INDEXED[model_cls]
+        # Instances only hold the fields they were created with, so unset ones are missing rather than None.
+        return (self.rowid(model_cls, row['id']), kind, row['id'], row.get(owner), row.get(title), row.get(body))
+
+    def add(self, database, o):
+        self.ensure(database)
+
+        # _data holds foreign keys as ids, which is all the index needs.
+        row = dict(o._data, id=o.id)
+        entry = self.entry(type(o), row)
+
+        database.execute_sql('DELETE FROM {} WHERE rowid = ?'.format(self.table), (entry[0], ))
+        database.execute_sql('INSERT INTO {} (rowid, kind, ref, owner, title, body) VALUES (?, ?, ?, ?, ?, ?)'.format(self.table), entry)
+
+    def remove(self, database, model_cls, ids):
+        self.ensure(database)
+
+        rowids = [self.rowid(model_cls, id) for id in ids]
+        if rowids:
+            database.execute_sql('DELETE FROM {} WHERE rowid IN ({})'.format(self.table, ', '.join('?' * len(rowids))), rowids)
+
+    def rebuild(self, database, models=tuple(INDEXED), batch_size=1000):
+        """Recreate the index from the rows of models that database holds."""
+        with database.atomic():
+            database.execute_sql('DROP TABLE IF EXISTS {}'.format(self.table))
+            self.create_table(database)
+
+            indexed = 0
+            tables = database.get_tables()
+            for model_cls in models:
+                if model_cls._meta.db_table not in tables:
+                    continue
+
+                for rows in batches(model_cls, database, batch_size):
+                    indexed += self.insert_many(database, [self.entry(model_cls, row) for row in rows])
+
+        logging.info('rebuilt search index: database=%s, indexed=%d', database.database, indexed)
+        return indexed
+
+    def insert_many(self, database, entries):
+        if entries:
+            sql = 'INSERT INTO {} (rowid, kind, ref, owner, title, body) VALUES (?, ?, ?, ?, ?, ?)'.format(self.table)
+            database.get_conn().executemany(sql, entries)
+        return len(entries)
+
+    def search(self, databases, term, owner=None, kind=None, page=1, per_page=DEFAULT_PER_PAGE):
+        """Best matches first as (score, kind, id, owner, snippet); owner restricts results to rows listed under that user.
+
+        bm25 scores depend on each database's own corpus, so each database's are scaled by its best match: the
+        score is 1.0 for that match and smaller for worse ones.
+        """
+        expression = match_expression(term)
+        limit = page * per_page
+        if not expression or limit > MAX_RESULTS:
+            return []
+
+        sql = ['SELECT bm25({0}) AS score, kind, ref, owner, snippet({0}, -1, \'[\', \']\', \'...\', 10) FROM {0} WHERE {0} MATCH ?'.format(self.table)]
+        params = [expression]
+        if owner is not None:
+            sql.append('AND owner = ?')
+            params.append(owner)
+        if kind is not None:
+            sql.append('AND kind = ?')
+            params.append(kind)
+        sql.append('ORDER BY score LIMIT ?')
+        params.append(limit)
+
+        results = []
+        for database in databases:
+            self.ensure(database)
+            rows = database.execute_sql(' '.join(sql), params).fetchall()
+
+            # bm25 scores are negative, lower for better matches.
+            best = rows[0][0] if rows else 0
+            results.append([((score / best) if best < 0 else 1.0, ) + tuple(row) for (score, *row) in rows])
+
+        return list(heapq.merge(*results, key=lambda r: -r[0]))[limit - per_page:limit]
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = SqliteDatabase(os.path.join(self.dir, 'search.db'))
+        with Using(self.db, [Message, Publication], with_transaction=False):
+            Message.create_table()
+            Publication.create_table()
+
+        self.index = SearchIndex()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def message(self, id, user, subject, body='', database=None, **kwargs):
+        database = database or self.db
+        on(Message.insert(id=id, user=user, subject=subject, body=body, **kwargs), database).execute()
+        o = on(Message.select().where(Message.id == id), database).get()
+        self.index.add(database, o)
+        return o
+
+    def ids(self, term, **kwargs):
+        return [r[2] for r in self.index.search([self.db], term, **kwargs)]
+
+    def test_search(self):
+        self.message(1, user=1, subject='breakfast time', body='eggs')
+        self.message(2, user=1, subject='nap time')
+
+        self.assertEqual(self.ids('breakfast'), [1])
+        self.assertEqual(sorted(self.ids('time')), [1, 2])
+        self.assertEqual(self.ids('time eggs'), [1])
+        self.assertEqual(self.ids('"quoted'), [])
+
+    def test_visibility(self):
+        self.message(1, user=1, subject='hello', to_user=2)
+        self.message(2, user=3, subject='hello', to_device=7)
+        self.message(3, user=3, subject='hello', to_publication=8)
+
+        # Only the sender's routes return a message, so recipients don't find it.
+        self.assertEqual(sorted(self.ids('hello')), [1, 2, 3])
+        self.assertEqual(self.ids('hello', owner=1), [1])
+        self.assertEqual(self.ids('hello', owner=2), [])
+        self.assertEqual(sorted(self.ids('hello', owner=3)), [2, 3])
+
+    def test_update_remove(self):
+        o = self.message(1, user=1, subject='hello')
+        o.subject = 'goodbye'
+        self.index.add(self.db, o)
+
+        self.assertEqual(self.ids('hello'), [])
+        self.assertEqual(self.ids('goodbye'), [1])
+
+        self.index.remove(self.db, Message, [1])
+        self.assertEqual(self.ids('goodbye'), [])
+
+    def test_paginate(self):
+        for id in range(1, 6):
+            self.message(id, user=1, subject='spam ' * id)
+
+        first = self.ids('spam', per_page=2)
+        second = self.ids('spam', page=2, per_page=2)
+        self.assertEqual(len(first + second), 4)
+        self.assertEqual(len(set(first + second)), 4)
+
+    def test_max_results(self):
+        self.message(1, user=1, subject='spam')
+
+        self.assertEqual(self.ids('spam', page=1, per_page=10), [1])
+        self.assertEqual(self.ids('spam', page=MAX_RESULTS // 10 + 1, per_page=10), [])
+
+    def test_scores_per_database(self):
+        other = SqliteDatabase(os.path.join(self.dir, 'other.db'))
+        with Using(other, [Message], with_transaction=False):
+            Message.create_table()
+
+        self.message(1, user=1, subject='spam')
+        self.message(2, user=1, subject='spam eggs')
+        self.message(3, user=1, subject='spam', database=other)
+        for id in range(4, 10):
+            self.message(id, user=1, subject='spam ham', database=other)
+
+        results = self.index.search([self.db, other], 'spam')
+        scores = [r[0] for r in results]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual([r[2] for r in results if r[0] == 1.0], [1, 3])
+        other.close()
+
+    def test_rebuild(self):
+        on(Message.insert(id=1, user=1, subject='unindexed'), self.db).execute()
+        on(Publication.insert(id=1, user=1, topic='weather', publish_group=1, subscribe_group=1), self.db).execute()
+
+        self.assertEqual(self.index.rebuild(self.db), 2)
+        self.assertEqual(self.ids('unindexed'), [1])
+        self.assertEqual(self.ids('weather', kind='publication'), [1])
+        self.assertEqual(self.ids('weather', kind='message'), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,336 @@
+#!venv/bin/python
+"""Production entry point.
+
+An asyncio (uvicorn) front end holds client connections, so idle keep-alive
+connections cost no threads, and the Flask app runs on a bounded thread pool.
+
+A long poll is a GET with If-None-Match and ?wait=<seconds> (up to
+--max-wait). While the resource still matches, the answer is a 304 and the
+poll waits on the event loop, not on a pool thread. One watcher per process
+checks the SQLite databases for commits by any process. Only when one of them
+changes is the request run again, briefly taking a pool thread. So thousands
+of waiting polls cost coroutines, not threads, and the pool stays free for
+CRUD work.
+
+    ./serve.py --host 0.0.0.0 --port 8000 --workers 4 --threads 16
+
+Defaults come from SERVE_HOST, SERVE_PORT, SERVE_WORKERS, SERVE_THREADS and
+SERVE_MAX_WAIT. SIGINT/SIGTERM stop accepting connections, drain in-flight
+requests and then shut the thread pool down.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from urllib.parse import parse_qs
+
+import uvicorn
+
+from a2wsgi import WSGIMiddleware
+from flask import Flask
+from flask import request
+from flask import Response
+
+from peewee import SqliteDatabase
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8000
+DEFAULT_WORKERS = 1
+DEFAULT_THREADS = 10
+DEFAULT_GRACEFUL_TIMEOUT = 30
+
+# Longest a long poll may wait, and how often the watcher checks the databases, in seconds.
+DEFAULT_MAX_WAIT = 60
+DEFAULT_CHECK_INTERVAL = 0.5
+
+class Changes:
+    """Notices commits to SQLite database files by any process, through PRAGMA data_version on connections of its own.
+
+    A watcher task runs while anyone is subscribed; each check runs on the loop's default executor, not the
+    request pool.
+    """
+
+    def __init__(self, paths, interval=DEFAULT_CHECK_INTERVAL):
+        self.paths = list(paths)
+        self.interval = interval
+        self.event = None
+
+        self._connections = None
+        self._waiters = 0
+        self._task = None
+        self._ready = None
+
+    def versions(self):
+        if self._connections is None:
+            self._connections = [sqlite3.connect(path, check_same_thread=False) for path in self.paths]
+        return [connection.execute('PRAGMA data_version').fetchone()[0] for connection in self._connections]
+
+    async def watch(self):
+        loop = asyncio.get_running_loop()
+        versions = await loop.run_in_executor(None, self.versions)
+        self._ready.set()
+
+        while True:
+            await asyncio.sleep(self.interval)
+            current = await loop.run_in_executor(None, self.versions)
+            if current != versions:
+                versions = current
+                (event, self.event) = (self.event, asyncio.Event())
+                event.set()
+
+    async def subscribe(self):
+        """Start watching, if no one else is; from then on each change sets, and replaces, self.event."""
+        self._waiters += 1
+        if self._task is None:
+            self.event = asyncio.Event()
+            self._ready = asyncio.Event()
+            self._task = asyncio.ensure_future(self.watch())
+        await self._ready.wait()
+
+    def unsubscribe(self):
+        self._waiters -= 1
+        if not self._waiters:
+            self._task.cancel()
+            self._task = None
+
+class AsgiAdapter:
+    """Exposes a WSGI app as an ASGI app, running each request on a bounded thread pool.
+
+    With changes (a Changes), long polls wait on the event loop between runs; see the module docstring.
+    """
+
+    def __init__(self, wsgi_app, threads=DEFAULT_THREADS, changes=None, max_wait=DEFAULT_MAX_WAIT):
+        self.threads = threads
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=threads)
+        self.changes = changes
+        self.max_wait = max_wait
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        wait = self.long_poll_wait(scope)
+        if wait:
+            await self.long_poll(scope, receive, send, wait)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    def long_poll_wait(self, scope):
+        """Seconds a long poll asks to wait, or None if scope isn't one."""
+        if self.changes is None or scope['type'] != 'http' or scope['method'] != 'GET':
+            return None
+        if not any(name == b'if-none-match' for (name, _) in scope['headers']):
+            return None
+
+        try:
+            wait = float(parse_qs(scope['query_string'].decode('latin-1')).get('wait', ['0'])[0])
+        except ValueError:
+            return None
+        return min(wait, self.max_wait) if wait > 0 else None
+
+    async def run(self, scope, body):
+        """The app's response to scope as ASGI messages, sent once it is complete."""
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.wsgi(scope, receive, send)
+        return sent
+
+    async def long_poll(self, scope, receive, send, wait):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        # The next message is http.disconnect; stop waiting if it comes.
+        disconnected = asyncio.ensure_future(receive())
+        try:
+            await self.changes.subscribe()
+            while True:
+                changed = self.changes.event
+                sent = await self.run(scope, body)
+
+                remaining = deadline - loop.time()
+                if sent[0]['status'] != 304 or remaining <= 0:
+                    break
+
+                waiter = asyncio.ensure_future(changed.wait())
+                await asyncio.wait([disconnected, waiter], timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if disconnected.done():
+                    return
+                if not changed.is_set():
+                    break
+        finally:
+            self.changes.unsubscribe()
+            disconnected.cancel()
+
+        for message in sent:
+            await send(message)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                logging.info('startup: threads=%d', self.threads)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                logging.info('shutdown: waiting for in-flight requests')
+                await asyncio.get_running_loop().run_in_executor(None, self.wsgi.executor.shutdown, True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+def create_app():
+    """uvicorn factory; also used for every process when workers > 1."""
+    from app import create_app as create_flask_app
+    from app import database
+    from app import shards
+
+    # Long polls watch every database the API reads, if it is an SQLite file.
+    paths = [db.database for db in [database.database] + shards.shards if isinstance(db, SqliteDatabase) and db.database != ':memory:']
+
+    return AsgiAdapter(create_flask_app(), threads=int(os.environ.get('SERVE_THREADS', DEFAULT_THREADS)), changes=Changes(paths),
+        max_wait=float(os.environ.get('SERVE_MAX_WAIT', DEFAULT_MAX_WAIT)))
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Serve the REST API.')
+    parser.add_argument('--host', default=os.environ.get('SERVE_HOST', DEFAULT_HOST))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVE_PORT', DEFAULT_PORT)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('SERVE_WORKERS', DEFAULT_WORKERS)), help='processes')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('SERVE_THREADS', DEFAULT_THREADS)), help='request threads per process')
+    parser.add_argument('--max-wait', type=float, default=float(os.environ.get('SERVE_MAX_WAIT', DEFAULT_MAX_WAIT)), help='longest a long poll may wait, in seconds')
+    parser.add_argument('--graceful-timeout', type=int, default=DEFAULT_GRACEFUL_TIMEOUT, help='seconds to drain connections on shutdown')
+    return parser.parse_args(args)
+
+def main(args=None):
+    args = parse_args(args)
+
+    # Worker processes re-import this module, so hand these down through the environment.
+    os.environ['SERVE_THREADS'] = str(args.threads)
+    os.environ['SERVE_MAX_WAIT'] = str(args.max_wait)
+
+    uvicorn.run('serve:create_app', factory=True, host=args.host, port=args.port, workers=args.workers,
+        timeout_graceful_shutdown=args.graceful_timeout, log_config=None, access_log=False)
+
+class TestAsgiAdapter(unittest.TestCase):
+    def setUp(self):
+        self.flask_app = Flask(__name__)
+        self.flask_app.add_url_rule('/ping', 'ping', lambda: ('pong', 200, {'Content-Type': 'text/plain'}))
+        self.adapter = AsgiAdapter(self.flask_app, threads=2)
+
+    def call(self, scope, messages):
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.adapter(scope, receive, send))
+        return sent
+
+    def scope(self, path, query_string=b'', headers=((b'host', b'localhost'), )):
+        return {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode('ascii'), 'root_path': '', 'query_string': query_string,
+            'headers': list(headers), 'server': ('localhost', 80), 'client': ('127.0.0.1', 1234),
+        }
+
+    def test_request(self):
+        sent = self.call(self.scope('/ping'), [{'type': 'http.request', 'body': b'', 'more_body': False}])
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(b''.join(m.get('body', b'') for m in sent[1:]), b'pong')
+
+    def test_lifespan(self):
+        sent = self.call({'type': 'lifespan'}, [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+
+        self.assertEqual([m['type'] for m in sent], ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertTrue(self.adapter.wsgi.executor._shutdown)
+
+    def test_long_poll(self):
+        dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dir, 'poll.db')
+            with sqlite3.connect(path) as connection:
+                connection.execute('CREATE TABLE item (value INTEGER)')
+                connection.execute('INSERT INTO item VALUES (0)')
+
+            def item():
+                connection = sqlite3.connect(path)
+                (value, ) = connection.execute('SELECT value FROM item').fetchone()
+                connection.close()
+
+                response = Response(str(value))
+                response.set_etag(str(value), weak=True)
+                return response.make_conditional(request)
+
+            def write():
+                time.sleep(0.3)
+                with sqlite3.connect(path) as connection:
+                    connection.execute('UPDATE item SET value = 1')
+
+            self.flask_app.add_url_rule('/item', 'item', item)
+            self.adapter = AsgiAdapter(self.flask_app, threads=2, changes=Changes([path], interval=0.05), max_wait=5)
+            scope = self.scope('/item', query_string=b'wait=5', headers=[(b'host', b'localhost'), (b'if-none-match', b'W/"0"')])
+
+            # Answered once another connection commits a change, well before wait runs out.
+            started = time.monotonic()
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_in_executor(None, write)
+                sent = loop.run_until_complete(self.poll(scope))
+            finally:
+                loop.close()
+            self.assertEqual(sent[0]['status'], 200)
+            self.assertEqual(b''.join(m.get('body', b'') for m in sent[1:]), b'1')
+            self.assertLess(time.monotonic() - started, 4)
+
+            # Nothing changes: 304 once wait runs out.
+            scope = self.scope('/item', query_string=b'wait=0.2', headers=[(b'host', b'localhost'), (b'if-none-match', b'W/"1"')])
+            self.assertEqual(asyncio.run(self.poll(scope))[0]['status'], 304)
+        finally:
+            shutil.rmtree(dir)
+
+    async def poll(self, scope):
+        sent = []
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        disconnected = asyncio.Event()
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.adapter(scope, receive, send)
+        return sent
+
+    def test_parse_args(self):
+        args = parse_args(['--workers', '4', '--threads', '16'])
+        self.assertEqual((args.workers, args.threads), (4, 16))
+
+if __name__ == '__main__':
+    main()
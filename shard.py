@@ -0,0 +1,437 @@
+#!venv/bin/python
+import heapq
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from collections import defaultdict
+
+from peewee import IntegrityError
+from peewee import SqliteDatabase
+from peewee import Using
+
+from playhouse.db_url import connect
+
+from adapter import Adapter
+from db import on
+from model import Device
+from model import Message
+from model import User
+from search import SearchIndex
+from writebehind import WriteBehind
+
+# Ids are allocated per shard as sequence * MAX_SHARDS + shard index, so they stay unique across shards
+# and survive rebalancing. Shard positions in the map are therefore permanent: only append new shards.
+MAX_SHARDS = 1024
+
+SEQUENCE_TABLE = 'shardsequence'
+
+SHARDED_MODELS = [Message]
+
+class ShardMap:
+    """Places each user's rows on one of the shard databases by user id."""
+
+    def __init__(self, shards=()):
+        self.shards = list(shards)
+        if len(self.shards) > MAX_SHARDS:
+            raise ValueError('Too many shards: {} > {}'.format(len(self.shards), MAX_SHARDS))
+
+    @classmethod
+    def from_env(cls):
+        """Shards from MESSAGE_SHARDS (comma-separated database URLs). Empty disables sharding."""
+        urls = [url.strip() for url in os.environ.get('MESSAGE_SHARDS', '').split(',') if url.strip()]
+        return cls([connect(url) for url in urls])
+
+    def __bool__(self):
+        return bool(self.shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def index_for(self, user_id):
+        return int(getattr(user_id, 'id', user_id)) % len(self.shards)
+
+    def shard_for(self, user_id):
+        return self.shards[self.index_for(user_id)]
+
+def create_tables(shard_map, models=SHARDED_MODELS):
+    for shard in shard_map.shards:
+        with Using(shard, models, with_transaction=False):
+            for model_cls in models:
+                model_cls.create_table(fail_silently=True)
+
+        shard.execute_sql('CREATE TABLE IF NOT EXISTS {} (value INTEGER NOT NULL)'.format(SEQUENCE_TABLE))
+        if not shard.execute_sql('SELECT COUNT(*) FROM {}'.format(SEQUENCE_TABLE)).fetchone()[0]:
+            shard.execute_sql('INSERT INTO {} (value) VALUES (0)'.format(SEQUENCE_TABLE))
+
+def advance_sequence(shard, ids):
+    """Move shard's sequence past ids that were copied in, so next_id() can't hand them out again."""
+    shard.execute_sql('UPDATE {} SET value = MAX(value, ?)'.format(SEQUENCE_TABLE), (max(ids) // MAX_SHARDS + 1, ))
+
+class ShardedAdapter(Adapter):
+    """Adapter for a model partitioned by user across a ShardMap.
+
+    Reads scoped to the owning user hit one shard; any other read fans out to every shard and merges the
+    results newest first (the model's order_by). Falls back to Adapter when no shards are configured.
+    """
+
+    shards = ShardMap()
+    shard_key = 'user'
+
+    def __init__(self, model_cls, parent_cls=None, **kwargs):
+        super(ShardedAdapter, self).__init__(model_cls=model_cls, parent_cls=parent_cls, **kwargs)
+
+        self.key_field = model_cls._meta.fields[self.shard_key]
+
+    def shards_for(self, parent=None):
+        if parent and self.parent_field is self.key_field:
+            return [self.shards.shard_for(parent)]
+        return self.shards.shards
+
+    def next_id(self, shard):
+        # Runs inside the insert's transaction, so the shard's write lock serializes allocation.
+        shard.execute_sql('UPDATE {} SET value = value + 1'.format(SEQUENCE_TABLE))
+        value = shard.execute_sql('SELECT value FROM {}'.format(SEQUENCE_TABLE)).fetchone()[0]
+        return value * MAX_SHARDS + self.shards.shards.index(shard)
+
+    def create_one(self, parent=None, **kwargs):
+        if not self.shards:
+            return super(ShardedAdapter, self).create_one(parent=parent, **kwargs)
+
+        o = self.model_cls(**kwargs)
+        o.touch()
+
+        shard = self.shard_for(o)
+
+        def create():
+            o.id = self.next_id(shard)
+            on(self.model_cls.insert(**o._data), shard).execute()
+            self.index(o, shard)
+            return o
+
+        return self.commit(shard, create)
+
+    def read_all(self, parent, **kwargs):
+        if not self.shards:
+            return super(ShardedAdapter, self).read_all(parent, **kwargs)
+
+        queries = []
+        for shard in self.shards_for(parent):
+            # Shards only hold the sharded table, so filter on the foreign key column instead of joining the parent.
+            query = self.model_cls.select()
+            if self.parent_field and parent:
+                query = query.where(self.parent_field == parent)
+            queries.append(on(query, shard))
+
+        if len(queries) == 1:
+            return queries[0]
+
+        # peewee's result iterator isn't itself iterable, which heapq.merge needs.
+        return heapq.merge(*[(o for o in query) for query in queries], key=lambda o: o.modified, reverse=True)
+
+    def read_many(self, ids, parent=None, **kwargs):
+        if not self.shards:
+            return super(ShardedAdapter, self).read_many(ids=ids, parent=parent, **kwargs)
+
+        found = {}
+        for shard in self.shards_for(parent):
+            query = self.model_cls.select().where(self.model_cls.id << list(ids))
+            if self.parent_field and parent:
+                query = query.where(self.parent_field == parent)
+            found.update((o.id, o) for o in on(query, shard))
+
+        return found
+
+    def find(self, id, parent=None):
+        for shard in self.shards_for(parent):
+            try:
+                return (on(self.model_cls.select().where(self.model_cls.id == id), shard).get(), shard)
+            except self.model_cls.DoesNotExist:
+                pass
+
+        logging.debug('find failed: model=%s, id=%s', self.model_cls.__name__, id)
+        raise self.model_cls.DoesNotExist('id={}'.format(id))
+
+    def read_one(self, id, parent=None, **kwargs):
+        if not self.shards:
+            return super(ShardedAdapter, self).read_one(id=id, parent=parent, **kwargs)
+
+        return self.find(id=id, parent=parent)[0]
+
+    def update_one(self, id, parent=None, **kwargs):
+        if not self.shards:
+            return super(ShardedAdapter, self).update_one(id=id, parent=parent, **kwargs)
+
+        (o, shard) = self.find(id=id, parent=parent)
+        for (k, v) in kwargs.items():
+            o.__setattr__(k, v)
+        o.touch()
+
+        target = self.shard_for(o)
+        if target is not shard:
+            return self.move(o, shard, target)
+
+        with shard.atomic():
+            on(self.model_cls.update(**o._data).where(self.model_cls.id == o.id), shard).execute()
+            self.index(o, shard)
+        return o
+
+    def shard_for(self, o):
+        key = o._data.get(self.shard_key)
+        if key is None:
+            raise IntegrityError('NOT NULL constraint failed: {}.{}'.format(self.model_cls._meta.db_table, self.key_field.db_column))
+        return self.shards.shard_for(key)
+
+    def move(self, o, source, target):
+        """Move o, whose shard key changed, from source to target under the same id, with its search entry.
+
+        Like rebalance(), o is written to target before it is deleted from source, so a failure in between
+        leaves a copy for rebalance() to clean up rather than losing the row.
+        """
+        with target.atomic():
+            on(self.model_cls.insert(**o._data), target).execute()
+            advance_sequence(target, [o.id])
+            self.index(o, target)
+
+        with source.atomic():
+            on(self.model_cls.delete().where(self.model_cls.id == o.id), source).execute()
+            self.unindex(o, source)
+
+        logging.debug('moved: model=%s, id=%s, source=%s, target=%s', self.model_cls.__name__, o.id, source.database, target.database)
+        return o
+
+    def delete_one(self, id, parent=None, **kwargs):
+        if not self.shards:
+            return super(ShardedAdapter, self).delete_one(id=id, parent=parent, **kwargs)
+
+        (o, shard) = self.find(id=id, parent=parent)
+        with shard.atomic():
+            on(self.model_cls.delete().where(self.model_cls.id == o.id), shard).execute()
+            self.unindex(o, shard)
+        return o
+
+def rebalance(shard_map, retired=(), models=SHARDED_MODELS, batch_size=500, search_index=None):
+    """Move rows that are not on the shard the map assigns them to, and with search_index their search entries.
+
+    Run after appending shards, or with the primary database as a retired source to migrate unsharded rows.
+    Each batch is copied before it is deleted from its source, so an interrupted run can simply be repeated:
+    rows already copied unchanged are skipped, while a different row with the same id raises IntegrityError
+    instead of being overwritten.
+    """
+    moved = 0
+
+    for model_cls in models:
+        key_column = model_cls._meta.fields[ShardedAdapter.shard_key].name
+        indexed = search_index is not None and search_index.supports(model_cls)
+
+        for source in shard_map.shards + list(retired):
+            last_id = 0
+
+            while True:
+                query = model_cls.select().where(model_cls.id > last_id).order_by(model_cls.id).limit(batch_size)
+                rows = list(on(query, source).dicts())
+                if not rows:
+                    break
+
+                last_id = rows[-1]['id']
+
+                targets = defaultdict(list)
+                for row in rows:
+                    target = shard_map.shard_for(row[key_column])
+                    if target is not source:
+                        targets[target].append(row)
+
+                for (target, target_rows) in targets.items():
+                    with target.atomic():
+                        ids = [row['id'] for row in target_rows]
+                        copied = {row['id']: row for row in on(model_cls.select().where(model_cls.id << ids), target).dicts()}
+                        for row in target_rows:
+                            if row['id'] in copied and copied[row['id']] != row:
+                                raise IntegrityError('{} id {} already exists on {}'.format(model_cls.__name__, row['id'], target.database))
+
+                        new_rows = [row for row in target_rows if row['id'] not in copied]
+                        if new_rows:
+                            on(model_cls.insert_many(new_rows), target).execute()
+                        advance_sequence(target, ids)
+
+                        if indexed:
+                            search_index.remove(target, model_cls, ids)
+                            search_index.insert_many(target, [search_index.entry(model_cls, row) for row in target_rows])
+
+                    with source.atomic():
+                        on(model_cls.delete().where(model_cls.id << ids), source).execute()
+                        if indexed:
+                            search_index.remove(source, model_cls, ids)
+
+                    moved += len(target_rows)
+
+            logging.info('rebalanced: model=%s, source=%s, moved=%d', model_cls.__name__, source.database, moved)
+
+    return moved
+
+class TestShardedAdapter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shard_map = ShardMap([SqliteDatabase(os.path.join(self.dir, 'shard{}.db'.format(i))) for i in range(2)])
+        create_tables(self.shard_map)
+
+        ShardedAdapter.shards = self.shard_map
+        self.adapter = ShardedAdapter(model_cls=Message)
+        self.user_adapter = ShardedAdapter(model_cls=Message, parent_cls=User)
+        self.device_adapter = ShardedAdapter(model_cls=Message, parent_cls=Device)
+
+    def tearDown(self):
+        ShardedAdapter.shards = ShardMap()
+        for shard in self.shard_map.shards:
+            shard.close()
+        shutil.rmtree(self.dir)
+
+    def count(self, shard):
+        return on(Message.select(), shard).count()
+
+    def test_create_placement(self):
+        a = self.adapter.create_one(user=2, subject='a')
+        b = self.adapter.create_one(user=3, subject='b')
+        c = self.adapter.create_one(user=4, subject='c')
+
+        self.assertEqual([self.count(shard) for shard in self.shard_map.shards], [2, 1])
+        self.assertEqual(len({a.id, b.id, c.id}), 3)
+        self.assertEqual(b.id % MAX_SHARDS, 1)
+
+    def test_create_write_behind(self):
+        write_behind = WriteBehind(max_rows=10, max_delay_ms=1)
+        adapter = ShardedAdapter(model_cls=Message, write_behind=write_behind)
+        try:
+            os = [adapter.create_one(user=user, subject=str(user)) for user in range(2, 5)]
+        finally:
+            write_behind.stop()
+
+        self.assertEqual([self.count(shard) for shard in self.shard_map.shards], [2, 1])
+        self.assertEqual([o.id % MAX_SHARDS for o in os], [0, 1, 0])
+        self.assertEqual(write_behind.groups, 3)
+
+    def test_create_requires_user(self):
+        self.assertRaises(IntegrityError, self.adapter.create_one, subject='a')
+
+    def test_read_all_merged(self):
+        for user in range(4):
+            self.adapter.create_one(user=user, subject=str(user))
+
+        messages = list(self.adapter.read_all(parent=None))
+        self.assertEqual([m.subject for m in messages], ['3', '2', '1', '0'])
+
+    def test_read_all_parent(self):
+        self.adapter.create_one(user=2, subject='a', to_device=7)
+        self.adapter.create_one(user=3, subject='b', to_device=7)
+        self.adapter.create_one(user=3, subject='c')
+
+        self.assertEqual([m.subject for m in self.user_adapter.read_all(parent='3')], ['c', 'b'])
+        self.assertEqual([m.subject for m in self.device_adapter.read_all(parent='7')], ['b', 'a'])
+
+    def test_read_update_delete(self):
+        o = self.adapter.create_one(user=3, subject='a')
+
+        self.assertEqual(self.adapter.read_one(id=o.id).subject, 'a')
+
+        o = self.adapter.update_one(id=o.id, subject='b')
+        self.assertEqual(o.revision, 2)
+        self.assertEqual(self.adapter.read_one(id=o.id).subject, 'b')
+
+        self.adapter.delete_one(id=o.id)
+        self.assertRaises(Message.DoesNotExist, self.adapter.read_one, id=o.id)
+
+    def test_update_moves(self):
+        self.adapter.search_index = SearchIndex()
+        o = self.adapter.create_one(user=2, subject='moving')
+        o = self.adapter.update_one(id=o.id, user=5)
+
+        (source, target) = self.shard_map.shards
+        self.assertEqual([self.count(shard) for shard in self.shard_map.shards], [0, 1])
+        self.assertEqual([m.id for m in self.user_adapter.read_all(parent=5)], [o.id])
+        self.assertEqual(list(self.user_adapter.read_many(ids=[o.id], parent=5)), [o.id])
+        self.assertEqual([r[2] for r in SearchIndex().search([source], 'moving')], [])
+        self.assertEqual([r[2] for r in SearchIndex().search([target], 'moving')], [o.id])
+
+        # The target's sequence moved past the id, so its new rows don't collide with it.
+        self.assertGreater(self.adapter.create_one(user=5, subject='new').id, o.id)
+
+    def test_read_many(self):
+        a = self.adapter.create_one(user=2, subject='a')
+        b = self.adapter.create_one(user=3, subject='b')
+
+        found = self.adapter.read_many(ids=[a.id, b.id, 1])
+        self.assertEqual(sorted(o.subject for o in found.values()), ['a', 'b'])
+        self.assertEqual(list(self.user_adapter.read_many(ids=[a.id, b.id], parent=3)), [b.id])
+
+    def test_rebalance(self):
+        for user in range(6):
+            self.adapter.create_one(user=user, subject=str(user))
+
+        # Append a shard; every user except 0 and 1 changes shards.
+        self.shard_map.shards.append(SqliteDatabase(os.path.join(self.dir, 'shard2.db')))
+        create_tables(self.shard_map)
+
+        self.assertEqual(rebalance(self.shard_map, batch_size=2), 4)
+        self.assertEqual([self.count(shard) for shard in self.shard_map.shards], [2, 2, 2])
+        self.assertEqual(rebalance(self.shard_map), 0)
+
+        self.assertEqual([m.subject for m in self.user_adapter.read_all(parent=5)], ['5'])
+
+    def test_rebalance_search(self):
+        search_index = SearchIndex()
+        self.adapter.search_index = search_index
+        o = self.adapter.create_one(user=5, subject='moving')
+
+        self.shard_map.shards.append(SqliteDatabase(os.path.join(self.dir, 'shard2.db')))
+        create_tables(self.shard_map)
+        self.assertEqual(rebalance(self.shard_map, search_index=search_index), 1)
+
+        # The entry moved with the row, so deleting it on its new shard leaves nothing to find.
+        self.assertEqual([r[2] for r in search_index.search(self.shard_map.shards, 'moving')], [o.id])
+        self.adapter.delete_one(id=o.id)
+        self.assertEqual(search_index.search(self.shard_map.shards, 'moving'), [])
+
+    def primary(self):
+        primary = SqliteDatabase(os.path.join(self.dir, 'primary.db'))
+        with Using(primary, [Message], with_transaction=False):
+            Message.create_table()
+        return primary
+
+    def test_rebalance_then_create(self):
+        primary = self.primary()
+        on(Message.insert(id=1024, user=2, subject='migrated'), primary).execute()
+
+        self.assertEqual(rebalance(self.shard_map, retired=[primary]), 1)
+        o = self.adapter.create_one(user=2, subject='new')
+
+        self.assertGreater(o.id, 1024)
+        self.assertEqual(sorted(m.subject for m in self.user_adapter.read_all(parent=2)), ['migrated', 'new'])
+        primary.close()
+
+    def test_rebalance_repeat(self):
+        primary = self.primary()
+        on(Message.insert(id=1024, user=2, subject='migrated'), primary).execute()
+
+        # As if an earlier run copied the row but stopped before deleting it.
+        row = on(Message.select().where(Message.id == 1024), primary).dicts().get()
+        on(Message.insert(**row), self.shard_map.shards[0]).execute()
+
+        self.assertEqual(rebalance(self.shard_map, retired=[primary]), 1)
+        self.assertEqual(self.count(self.shard_map.shards[0]), 1)
+        self.assertEqual(self.count(primary), 0)
+        primary.close()
+
+    def test_rebalance_collision(self):
+        primary = self.primary()
+        o = self.adapter.create_one(user=2, subject='sharded')
+        on(Message.insert(id=o.id, user=2, subject='other'), primary).execute()
+
+        self.assertRaises(IntegrityError, rebalance, self.shard_map, retired=[primary])
+        self.assertEqual(on(Message.select().where(Message.id == o.id), self.shard_map.shards[0]).get().subject, 'sharded')
+        self.assertEqual(self.count(primary), 1)
+        primary.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,34 @@
 #!venv/bin/python
+import gzip
 import json
-import logging
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
 
 from base64 import b64encode
 
+from flask import Flask
+
 from peewee import SqliteDatabase
 
 from app import app
-from app import prepare_routes
+from app import create_app
+from app import limiter
+from app import router
+from app import write_behind
+from adapter import Adapter
+from passwords import Passwords
+from ratelimit import MemoryBuckets
+from view import View
+from writebehind import WriteBehind
 
 import model
+import retention
+import search
+import shard
 
 from secrets import APP_API_KEY
 from secrets import MESSAGING_API_KEY
@@ -20,6 +37,9 @@ from secrets import TEST_PASSWORD
 from secrets import TEST_CREDENTIALS
 
 class TestBase(unittest.TestCase):
+    # In-memory copy of the seeded database, taken once and restored before every test.
+    snapshot = None
+
     def populate_database(self):
         self.db = SqliteDatabase('peewee.db')
         self.db.connect()
@@ -81,9 +101,22 @@ class TestBase(unittest.TestCase):
         model.UserToGroup.create(user=ducky, group=user)
         model.UserToGroup.create(user=ducky, group=guest)
 
+        search.SearchIndex().rebuild(model.BaseModel._meta.database)
+
+    def restore_database(self):
+        conn = model.BaseModel._meta.database.get_conn()
+
+        if TestBase.snapshot is None:
+            self.populate_database()
+            TestBase.snapshot = sqlite3.connect(':memory:')
+            conn.backup(TestBase.snapshot)
+        else:
+            TestBase.snapshot.backup(conn)
+
     def setUp(self):
         self.app = app.test_client()
-        self.populate_database()
+        self.restore_database()
+        limiter.buckets = MemoryBuckets()
 
     def request(self, method, url, auth=None, json_data=None, **kwargs):
         headers = kwargs.get('headers', {})
@@ -121,6 +154,20 @@ class TestUser(TestBase):
         j = json.loads(response.data.decode('utf-8'))
         self.assertEqual(j['uri'], 'http://localhost/api/v1.0/users/3')
 
+    def test_conditional(self):
+        response = self.request('GET', '/api/v1.0/users/', auth=TEST_CREDENTIALS)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+
+        response = self.request('GET', '/api/v1.0/users/', auth=TEST_CREDENTIALS, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        self.request('PATCH', '/api/v1.0/users/3', auth=TEST_CREDENTIALS, json_data={'description': 'changed'})
+        response = self.request('GET', '/api/v1.0/users/', auth=TEST_CREDENTIALS, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
     def test_create_one(self):
         json_data = {
             'name' : 'Guinness',
@@ -250,7 +297,404 @@ class TestGroup(TestBase):
         self.assertEqual(j['name'], TEST_USER)
         self.assertEqual(j['uri'], 'http://localhost/api/v1.0/groups/1')
 
+class TestMultiGet(TestBase):
+    def get(self, url, auth=TEST_CREDENTIALS):
+        response = self.request('GET', url, auth=auth)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode('utf-8'))
+
+    def test_query(self):
+        j = self.get('/api/v1.0/messages/?ids=3,1,2')
+        self.assertEqual([m['id'] for m in j], [3, 1, 2])
+        self.assertEqual(j[1]['subject'], 'First post!')
+        self.assertEqual(j[1]['uri'], 'http://localhost/api/v1.0/users/3/messages/1')
+
+    def test_path(self):
+        j = self.get('/api/v1.0/users/3/messages/2,1')
+        self.assertEqual([m['subject'] for m in j], ['Eating breakfast', 'First post!'])
+
+    def test_not_found(self):
+        j = self.get('/api/v1.0/messages/?ids=1,1000,1')
+        self.assertEqual([m['id'] for m in j], [1, 1000, 1])
+        self.assertEqual(j[1], {'id': 1000, 'error': 'Not found'})
+
+    def test_parent_scope(self):
+        # Message 4 was sent by felix, not sunshine.
+        j = self.get('/api/v1.0/users/3/messages/?ids=1,4', auth=('sunshine', TEST_PASSWORD))
+        self.assertEqual(j[0]['id'], 1)
+        self.assertEqual(j[1], {'id': 4, 'error': 'Not found'})
+
+    def test_invalid(self):
+        for ids in ('a,1', ',', ','.join(str(i) for i in range(101))):
+            response = self.request('GET', '/api/v1.0/messages/?ids=' + ids, auth=TEST_CREDENTIALS)
+            self.assertEqual(response.status_code, 400)
+
+class TestWarm(unittest.TestCase):
+    def test_warm(self):
+        warm_app = Flask(__name__)
+        View.add(warm_app, base_url='/devices', endpoint='devices', adapter=lambda: Adapter(model_cls=model.Device), schema_cls='schema.DeviceSchema')
+        state = warm_app.view_functions['devices'].endpoint_state
+        self.assertTrue(callable(state._adapter))
+        self.assertFalse(hasattr(state._local, 'schema'))
+
+        View.warm(warm_app)
+        self.assertIsInstance(state._adapter, Adapter)
+        self.assertTrue(hasattr(state._local, 'schema'))
+
+class TestCompression(TestBase):
+    def test_gzip(self):
+        response = self.request('GET', '/api/v1.0/users/', auth=TEST_CREDENTIALS, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+        j = json.loads(gzip.decompress(response.data).decode('utf-8'))
+        self.assertEqual(len(j), 6)
+
+    def test_identity(self):
+        response = self.request('GET', '/api/v1.0/users/', auth=TEST_CREDENTIALS)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))), 6)
+
+    def test_static(self):
+        response = self.request('GET', '/index.html', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('max-age', response.headers['Cache-Control'])
+
+        response = self.request('GET', '/index.html', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+class TestReadReplica(TestBase):
+    def setUp(self):
+        super(TestReadReplica, self).setUp()
+
+        # A copy of the seeded database stands in for a replica.
+        shutil.copyfile('peewee.db', 'peewee_replica.db')
+        self.replica = SqliteDatabase('peewee_replica.db')
+        router.set_replicas([self.replica])
+
+    def tearDown(self):
+        router.set_replicas([])
+        self.replica.close()
+        os.remove('peewee_replica.db')
+
+    def test_get_from_replica(self):
+        model.Group.create(name='primary', owner=1)
+
+        # ducky has not written, so is not pinned to the primary.
+        response = self.request('GET', '/api/v1.0/groups/', auth=('ducky', TEST_PASSWORD))
+        self.assertEqual(response.status_code, 200)
+
+        j = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(j), 3)
+
+    def test_read_your_writes(self):
+        json_data = {
+            'app_api_key' : 'a',
+            'messaging_api_key' : 'm',
+        }
+
+        response = self.request('POST', '/api/v1.0/configs/', auth=TEST_CREDENTIALS, json_data=json_data)
+        self.assertEqual(response.status_code, 201)
+
+        response = self.request('GET', '/api/v1.0/configs/', auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 200)
+
+        j = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(j), 2)
+
+class TestShardedMessages(TestBase):
+    def setUp(self):
+        super(TestShardedMessages, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        self.shards = shard.ShardMap([SqliteDatabase(os.path.join(self.dir, 'shard{}.db'.format(i))) for i in range(2)])
+        shard.create_tables(self.shards)
+        shard.rebalance(self.shards, retired=[model.BaseModel._meta.database])
+        shard.ShardedAdapter.shards = self.shards
+
+    def tearDown(self):
+        shard.ShardedAdapter.shards = shard.ShardMap()
+        for db in self.shards.shards:
+            db.close()
+        shutil.rmtree(self.dir)
+
+    def test_get_all(self):
+        self.assertEqual(model.Message.select().count(), 0)
+
+        response = self.request('GET', '/api/v1.0/messages/', auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 200)
+
+        j = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(j), 7)
+        self.assertEqual(j, sorted(j, key=lambda m: m['modified'], reverse=True))
+
+    def test_get_parent(self):
+        response = self.request('GET', '/api/v1.0/users/3/messages/', auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 200)
+
+        j = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(j), 3)
+        self.assertEqual(j[0]['uri'], 'http://localhost/api/v1.0/users/3/messages/{}'.format(j[0]['id']))
+
+    def test_get_many(self):
+        response = self.request('GET', '/api/v1.0/messages/?ids=7,1,1000', auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 200)
+
+        j = json.loads(response.data.decode('utf-8'))
+        self.assertEqual([m['id'] for m in j], [7, 1, 1000])
+        self.assertEqual(j[2]['error'], 'Not found')
+
+    def test_patch_user(self):
+        # Message 1 moves from sunshine's shard to guinness's.
+        response = self.request('PATCH', '/api/v1.0/users/3/messages/1', auth=TEST_CREDENTIALS, json_data={'user': 4})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.request('GET', '/api/v1.0/users/4/messages/', auth=TEST_CREDENTIALS)
+        self.assertEqual([m['id'] for m in json.loads(response.data.decode('utf-8'))], [1])
+
+        response = self.request('GET', '/api/v1.0/users/4/messages/?ids=1', auth=TEST_CREDENTIALS)
+        self.assertEqual(json.loads(response.data.decode('utf-8'))[0]['subject'], 'First post!')
+
+class TestRetention(TestBase):
+    def setUp(self):
+        super(TestRetention, self).setUp()
+
+        self.dir = tempfile.mkdtemp()
+        shard.ShardedAdapter.archive = retention.Archive(self.dir)
+
+    def tearDown(self):
+        shard.ShardedAdapter.archive = None
+        shutil.rmtree(self.dir)
+
+    def test_create_policy(self):
+        json_data = {
+            'user' : 3,
+            'max_count' : 1,
+        }
+
+        response = self.request('POST', '/api/v1.0/retentions/', auth=TEST_CREDENTIALS, json_data=json_data)
+        self.assertEqual(response.status_code, 201)
+
+        j = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(j['user'], 3)
+        self.assertEqual(j['max_age_days'], None)
+
+    def test_get_archived(self):
+        model.Retention.create(user=3, max_count=1)
+        retention.apply_policies([model.BaseModel._meta.database], shard.ShardedAdapter.archive)
+
+        response = self.request('GET', '/api/v1.0/users/3/messages/', auth=TEST_CREDENTIALS)
+        j = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(j), 1)
+
+        response = self.request('GET', '/api/v1.0/users/3/messages/?archived=1', auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 200)
+
+        j = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(len(j), 2)
+
+        response = self.request('GET', '/api/v1.0/users/3/messages/{}?archived=1'.format(j[0]['id']), auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.request('GET', '/api/v1.0/users/3/messages/{}'.format(j[0]['id']), auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 404)
+
+    def test_archived_elsewhere(self):
+        # Users have no archive, so the parameter is ignored.
+        response = self.request('GET', '/api/v1.0/users/?archived=1', auth=TEST_CREDENTIALS)
+        self.assertEqual(len(json.loads(response.data.decode('utf-8'))), 6)
+
+        response = self.request('GET', '/api/v1.0/users/3?archived=1', auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 200)
+
+    def test_archived_invalid(self):
+        for url in ('/api/v1.0/users/abc/messages/?archived=1', '/api/v1.0/users/3/messages/abc?archived=1'):
+            response = self.request('GET', url, auth=TEST_CREDENTIALS)
+            self.assertEqual(response.status_code, 400)
+
+class TestRehash(TestBase):
+    def setUp(self):
+        super(TestRehash, self).setUp()
+
+        self.passwords = model.User.passwords
+        model.User.passwords = Passwords(default='pbkdf2_sha256', iterations=1000)
+
+    def tearDown(self):
+        model.User.passwords = self.passwords
+
+    def password(self, username):
+        return model.User.get(model.User.username == username).password
+
+    def test_rehash_on_login(self):
+        self.assertTrue(self.password('sunshine').startswith('$p5k2$'))
+
+        response = self.request('GET', '/api/v1.0/users/3/messages/', auth=('sunshine', TEST_PASSWORD))
+        self.assertEqual(response.status_code, 200)
+
+        password = self.password('sunshine')
+        self.assertTrue(password.startswith('$pbkdf2-sha256$1000$'))
+
+        response = self.request('GET', '/api/v1.0/users/3/messages/', auth=('sunshine', TEST_PASSWORD))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.password('sunshine'), password)
+
+    def test_no_rehash_on_failure(self):
+        password = self.password('sunshine')
+
+        response = self.request('GET', '/api/v1.0/users/3/messages/', auth=('sunshine', 'wrong'))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.password('sunshine'), password)
+
+class TestRateLimit(TestBase):
+    def setUp(self):
+        super(TestRateLimit, self).setUp()
+
+        self.rate = limiter.rate_for('messages')
+        limiter.set_rate('messages', '2/60')
+
+    def tearDown(self):
+        limiter.set_rate('messages', self.rate)
+
+    def get(self, device='a', auth=TEST_CREDENTIALS):
+        return self.request('GET', '/api/v1.0/users/3/messages/', auth=auth, headers={'X-Device-Id': device})
+
+    def test_limit(self):
+        self.assertEqual([self.get().status_code for _ in range(3)], [200, 200, 429])
+
+        response = self.get()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '30')
+
+    def test_per_device_and_user(self):
+        self.get()
+        self.get()
+
+        self.assertEqual(self.get(device='b').status_code, 200)
+        self.assertEqual(self.get(auth=('sunshine', TEST_PASSWORD)).status_code, 200)
+
+    def test_per_endpoint(self):
+        self.get()
+        self.get()
+
+        response = self.request('GET', '/api/v1.0/users/', auth=TEST_CREDENTIALS, headers={'X-Device-Id': 'a'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_unauthenticated(self):
+        response = self.get(auth=('sunshine', 'wrong'))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(len(limiter.buckets), 0)
+
+class TestSearch(TestBase):
+    def search(self, query, auth):
+        response = self.request('GET', '/api/v1.0/search?' + query, auth=auth)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode('utf-8'))
+
+    def test_search(self):
+        j = self.search('q=breakfast', auth=('sunshine', TEST_PASSWORD))
+        self.assertEqual(len(j), 1)
+        self.assertEqual(j[0]['kind'], 'message')
+        self.assertEqual(j[0]['uri'], 'http://localhost/api/v1.0/users/3/messages/{}'.format(j[0]['id']))
+        self.assertIn('[breakfast]', j[0]['snippet'].lower())
+
+    def test_visibility(self):
+        # Sent by felix, to chloe and one of her devices: only felix finds them.
+        self.assertEqual(self.search('q=chloe', auth=('chloe', TEST_PASSWORD)), [])
+        self.assertEqual(len(self.search('q=chloe', auth=TEST_CREDENTIALS)), 2)
+
+        j = self.search('q=chloe', auth=('felix', TEST_PASSWORD))
+        self.assertEqual(len(j), 2)
+        for r in j:
+            response = self.request('GET', r['uri'].replace('http://localhost', ''), auth=('felix', TEST_PASSWORD))
+            self.assertEqual(response.status_code, 200)
+
+        # Sunshine's publication, which chloe may subscribe to but not read.
+        self.assertEqual(self.search('q=sunshine&kind=publication', auth=('chloe', TEST_PASSWORD)), [])
+        self.assertEqual(len(self.search('q=sunshine&kind=publication', auth=('sunshine', TEST_PASSWORD))), 1)
+
+    def test_page_limit(self):
+        self.assertEqual(self.search('q=sunshine&page=1000000&per_page=100', auth=TEST_CREDENTIALS), [])
+
+    def test_kind(self):
+        j = self.search('q=sunshine&kind=publication', auth=TEST_CREDENTIALS)
+        self.assertEqual([r['kind'] for r in j], ['publication'])
+
+    def test_incremental(self):
+        json_data = {
+            'user' : 3,
+            'subject' : 'Lunch',
+            'body' : 'sandwiches',
+        }
+
+        response = self.request('POST', '/api/v1.0/users/3/messages/', auth=TEST_CREDENTIALS, json_data=json_data)
+        self.assertEqual(response.status_code, 201)
+        id = json.loads(response.data.decode('utf-8'))['id']
+
+        self.assertEqual([r['id'] for r in self.search('q=sandwiches', auth=TEST_CREDENTIALS)], [id])
+
+        response = self.request('DELETE', '/api/v1.0/users/3/messages/{}'.format(id), auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.search('q=sandwiches', auth=TEST_CREDENTIALS), [])
+
+    def test_missing_query(self):
+        response = self.request('GET', '/api/v1.0/search', auth=TEST_CREDENTIALS)
+        self.assertEqual(response.status_code, 400)
+
+class TestWriteBehind(TestBase):
+    def setUp(self):
+        super(TestWriteBehind, self).setUp()
+
+        # A write-behind of its own on the messages endpoint, instead of reconfiguring the app's.
+        self.adapter = app.view_functions['messages'].endpoint_state.adapter
+        self.write_behind = WriteBehind(max_rows=10, max_delay_ms=200)
+        self.adapter.write_behind = self.write_behind
+
+    def tearDown(self):
+        self.adapter.write_behind = write_behind
+        self.write_behind.stop()
+
+    def post(self, subject):
+        return self.request('POST', '/api/v1.0/users/3/messages/', auth=TEST_CREDENTIALS, json_data={'user': 3, 'subject': subject, 'body': ''})
+
+    def test_create(self):
+        response = self.post('Lunch')
+        self.assertEqual(response.status_code, 201)
+
+        id = json.loads(response.data.decode('utf-8'))['id']
+        self.assertEqual(model.Message.get(model.Message.id == id).subject, 'Lunch')
+        self.assertEqual(self.write_behind.groups, 1)
+
+    def test_concurrent(self):
+        responses = []
+        threads = [threading.Thread(target=lambda i=i: responses.append(self.post(str(i)))) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([r.status_code for r in responses], [201] * 10)
+        ids = {json.loads(r.data.decode('utf-8'))['id'] for r in responses}
+        self.assertEqual(len(ids), 10)
+        self.assertEqual(model.Message.select().where(model.Message.id << list(ids)).count(), 10)
+        self.assertLess(self.write_behind.groups, 10)
+
+    def test_unavailable(self):
+        self.write_behind.timeout = 0
+        response = self.post('Lunch')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['error'], 'Service unavailable')
+
+    def test_invalid(self):
+        # Rejected by validation before it is queued.
+        response = self.request('POST', '/api/v1.0/users/3/messages/', auth=TEST_CREDENTIALS, json_data={'user': 3})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.write_behind.groups, 0)
+
 if __name__ == '__main__':
-    logging.basicConfig(level=logging.DEBUG, format='%(levelname)s %(module)s.%(funcName)s#%(lineno)d %(message)s')
-    prepare_routes()
+    create_app()
+    model.User.passwords = Passwords(iterations=1)
     unittest.main()
\ No newline at end of file
@@ -1,25 +1,83 @@
 #!venv/bin/python
+import hashlib
+import json
 import logging
+import threading
 
 from flask import abort
 from flask import request
 from flask.views import MethodView
 
+from werkzeug.utils import import_string
+
 from flask_httpauth import HTTPBasicAuth
 
 from seq_tools import to_sequence_or_set
 
+class Endpoint:
+    """An endpoint's adapter and schemas, built on its first request rather than when the route is added.
+
+    adapter may be a zero-argument factory and schema_cls an import path such as 'schema.UserSchema'. Schemas
+    are kept per thread because marshmallow schemas hold state while they dump or validate.
+    """
+
+    def __init__(self, adapter, schema_cls):
+        self._adapter = adapter
+        self._schema_cls = schema_cls
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def adapter(self):
+        if callable(self._adapter):
+            with self._lock:
+                if callable(self._adapter):
+                    self._adapter = self._adapter()
+        return self._adapter
+
+    @property
+    def schema_cls(self):
+        if isinstance(self._schema_cls, str):
+            self._schema_cls = import_string(self._schema_cls)
+        return self._schema_cls
+
+    def warm(self):
+        """Build the adapter, and this thread's schemas, now instead of on the first request."""
+        self.adapter
+        self.schemas()
+
+    def schemas(self):
+        local = self._local
+        if not hasattr(local, 'schema'):
+            local.schema = self.schema_cls()
+            local.schema_many = self.schema_cls(many=True)
+        return (local.schema, local.schema_many)
+
 class View(MethodView):
-    def __init__(self, adapter, schema_cls, **kwargs):
+    # Optional ratelimit.RateLimiter that add() registers endpoint rates with.
+    limiter = None
+
+    # Most ids one multi-get may ask for.
+    max_ids = 100
+
+    def __init__(self, endpoint, **kwargs):
         super(View, self).__init__()
 
-        self.adapter = adapter
-        self.schema_cls = schema_cls
-        self.schema = schema_cls()
-        self.schema_many = schema_cls(many=True)
+        self.adapter = endpoint.adapter
+        self.schema_cls = endpoint.schema_cls
+        (self.schema, self.schema_many) = endpoint.schemas()
 
     def get(self, id, parent=None, **kwargs):
-        logging.debug('id={}, parent={}, kwargs={}'.format(id, parent, kwargs))
+        logging.debug('id=%s, parent=%s, kwargs=%s', id, parent, kwargs)
+
+        # Only adapters with an archive have archived rows; elsewhere the parameter is ignored.
+        if self.adapter.archive and request.args.get('archived') in ('1', 'true'):
+            return self.get_archived(id=id, parent=parent, **kwargs)
+
+        # /<id>,<id>... or ?ids=<id>,<id>... on the collection.
+        ids = request.args.get('ids') if id is None else (id if ',' in id else None)
+        if ids is not None:
+            return self.get_many(ids=ids, parent=parent, **kwargs)
 
         if id:
             try:
@@ -35,10 +93,65 @@ class View(MethodView):
         if mresults.errors:
             abort(404)
 
+        return self.conditional(mresults.data)
+
+    def conditional(self, data):
+        """data as JSON with a weak ETag, or 304 when If-None-Match already has it; serve.py long polls on this."""
+        etag = hashlib.sha1(data.encode('utf-8')).hexdigest()[:20]
+        headers = {'ETag': 'W/"{}"'.format(etag)}
+        if request.if_none_match.contains_weak(etag):
+            return '', 304, headers
+
+        headers['Content-Type'] = 'application/json'
+        return data, 200, headers
+
+    def get_many(self, ids, parent=None, **kwargs):
+        try:
+            ids = [int(id) for id in ids.split(',') if id.strip()]
+        except ValueError:
+            abort(400)
+
+        if not ids or len(ids) > self.max_ids:
+            abort(400)
+
+        found = self.adapter.read_many(ids=set(ids), parent=parent, **kwargs)
+
+        # Requested order, with a marker in place of each id that doesn't exist or isn't under parent.
+        results = []
+        for id in ids:
+            if id not in found:
+                results.append({'id': id, 'error': 'Not found'})
+                continue
+
+            mresult = self.schema.dump(found[id])
+            if mresult.errors:
+                abort(404)
+            results.append(mresult.data)
+
+        return self.conditional(json.dumps(results))
+
+    def get_archived(self, id, parent=None, **kwargs):
+        try:
+            (id, parent) = (int(v) if v is not None else None for v in (id, parent))
+        except ValueError:
+            abort(400)
+
+        os = self.adapter.read_archived(id=id, parent=parent, **kwargs)
+
+        if id:
+            if not os:
+                abort(404)
+            mresults = self.schema.dumps(os[0])
+        else:
+            mresults = self.schema_many.dumps(os)
+
+        if mresults.errors:
+            abort(404)
+
         return mresults.data, 200, {'Content-Type': 'application/json'}
 
     def post(self, id, parent=None, **kwargs):
-        logging.debug('id={}, parent={}, kwargs={}'.format(id, parent, kwargs))
+        logging.debug('id=%s, parent=%s, kwargs=%s', id, parent, kwargs)
 
         if not request.json:
             abort(400)
@@ -47,7 +160,7 @@ class View(MethodView):
         request.json.update(kwargs)
 
         errors = self.schema.validate(request.json, partial=False)
-        logging.debug('errors={}'.format(errors))
+        logging.debug('errors=%s', errors)
         if errors:
             abort(400)
 
@@ -60,13 +173,13 @@ class View(MethodView):
         return mresults.data, 201, {'Content-Type': 'application/json'}
 
     def __update(self, partial, id, parent=None, **kwargs):
-        logging.debug('partial={}, id={}, parent={}, kwargs={}'.format(partial, id, parent, kwargs))
+        logging.debug('partial=%s, id=%s, parent=%s, kwargs=%s', partial, id, parent, kwargs)
 
         if not request.json:
             abort(400)
 
         errors = self.schema.validate(request.json, partial=partial)
-        logging.debug('errors={}'.format(errors))
+        logging.debug('errors=%s', errors)
         if errors:
             abort(400)
 
@@ -82,15 +195,15 @@ class View(MethodView):
         return mresults.data, 200, {'Content-Type': 'application/json'}
 
     def put(self, id, parent=None, **kwargs):
-        logging.debug('id={}, parent={}, kwargs={}'.format(id, parent, kwargs))
+        logging.debug('id=%s, parent=%s, kwargs=%s', id, parent, kwargs)
         return self.__update(partial=False, id=id, parent=parent, **kwargs)
 
     def patch(self, id, parent=None, **kwargs):
-        logging.debug('id={}, parent={}, kwargs={}'.format(id, parent, kwargs))
+        logging.debug('id=%s, parent=%s, kwargs=%s', id, parent, kwargs)
         return self.__update(partial=True, id=id, parent=parent, **kwargs)
 
     def delete(self, id, parent=None, **kwargs):
-        logging.debug('id={}, parent={}, kwargs={}'.format(id, parent, kwargs))
+        logging.debug('id=%s, parent=%s, kwargs=%s', id, parent, kwargs)
 
         try:
             o = self.adapter.delete_one(id=id)
@@ -104,17 +217,24 @@ class View(MethodView):
         return mresults.data, 200, {'Content-Type': 'application/json'}
 
     @classmethod
-    def add(cls, app, base_url, endpoint, adapter, schema_cls):
+    def add(cls, app, base_url, endpoint, adapter, schema_cls, rate=None):
+        """Register endpoint's routes; see Endpoint for when adapter and schema_cls are built."""
         for endpoint in to_sequence_or_set(endpoint):
-            view_func = View.as_view(endpoint, adapter=adapter, schema_cls=schema_cls)
+            state = Endpoint(adapter=adapter, schema_cls=schema_cls)
+            view_func = View.as_view(endpoint, endpoint=state)
+            view_func.endpoint_state = state
+
+            if rate and cls.limiter:
+                cls.limiter.set_rate(endpoint, rate)
 
             for base_url in to_sequence_or_set(base_url):
-                methods = ('GET', 'POST', 'DELETE')
-                url = base_url + '/'
-                logging.debug('methods={}, url={}'.format(methods, url))
-                app.add_url_rule(url, methods=methods, defaults={'id' : None}, view_func=view_func)
-
-                methods = ('GET', 'PUT', 'PATCH', 'DELETE')
-                url = base_url + '/<string:id>'
-                logging.debug('methods={}, url={}'.format(methods, url))
-                app.add_url_rule(url, methods=methods, defaults={}, view_func=view_func)
\ No newline at end of file
+                app.add_url_rule(base_url + '/', methods=('GET', 'POST', 'DELETE'), defaults={'id' : None}, view_func=view_func)
+                app.add_url_rule(base_url + '/<string:id>', methods=('GET', 'PUT', 'PATCH', 'DELETE'), defaults={}, view_func=view_func)
+
+    @classmethod
+    def warm(cls, app):
+        """Build every endpoint added to app, e.g. in a prefork master so its workers share them copy-on-write."""
+        for view_func in app.view_functions.values():
+            state = getattr(view_func, 'endpoint_state', None)
+            if state is not None:
+                state.warm()
@@ -0,0 +1,287 @@
+#!venv/bin/python
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError
+
+from werkzeug.exceptions import ServiceUnavailable
+
+from peewee import IntegrityError
+from peewee import SqliteDatabase
+from peewee import Using
+
+from db import on
+from model import Message
+
+DEFAULT_MAX_DELAY_MS = 5
+
+# Seconds a request waits for its group to commit before giving up with 503.
+DEFAULT_TIMEOUT = 10
+
+class WriteBehindUnavailable(ServiceUnavailable):
+    description = 'The write was not committed in time.'
+
+class WriteBehind:
+    """Group commit: writes from many request threads share one transaction, and so one sync to disk.
+
+    A background thread runs queued writes in a transaction per database, up to max_rows writes or max_delay_ms
+    after the first one, whichever comes first. If a write fails, the group is rolled back and redone with a
+    savepoint per write, so it only fails its own caller; writes must therefore be safe to run again. Callers
+    block until the transaction holding their write commits, so nothing is acknowledged that isn't durable, and
+    get WriteBehindUnavailable (503) after timeout seconds or if the writer thread dies. Disabled (falsy) while
+    max_rows is 0.
+    """
+
+    def __init__(self, max_rows=0, max_delay_ms=DEFAULT_MAX_DELAY_MS, timeout=DEFAULT_TIMEOUT):
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self.timeout = timeout
+        self.groups = 0
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Group size from WRITE_BEHIND_ROWS (default 0, disabled), delay from WRITE_BEHIND_MS, timeout from WRITE_BEHIND_TIMEOUT."""
+        return cls(
+            max_rows=int(os.environ.get('WRITE_BEHIND_ROWS', 0)),
+            max_delay_ms=float(os.environ.get('WRITE_BEHIND_MS', DEFAULT_MAX_DELAY_MS)),
+            timeout=float(os.environ.get('WRITE_BEHIND_TIMEOUT', DEFAULT_TIMEOUT)))
+
+    def __bool__(self):
+        return self.max_rows > 0
+
+    def start(self):
+        with self._lock:
+            # The writer thread does not survive fork(), and is replaced if it died.
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
+
+    def submit(self, database, fn):
+        """Run fn on the writer thread inside the next group's transaction on database; return its result once committed."""
+        self.start()
+
+        future = Future()
+        self._queue.put((database, fn, future))
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # A queued write is cancelled so it never runs; one already in a group may still commit.
+            cancelled = future.cancel()
+            logging.warning('write-behind timed out: timeout=%s, cancelled=%s', self.timeout, cancelled)
+            raise WriteBehindUnavailable()
+
+    def run(self):
+        databases = set()
+        batch = []
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+
+                batch = [item]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_rows:
+                    try:
+                        item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self._queue.put(None)
+                        break
+                    batch.append(item)
+
+                databases.update(database for (database, _, _) in batch)
+                self.commit(batch)
+        except Exception:
+            logging.exception('write-behind writer failed')
+        finally:
+            # Nothing is left waiting on a writer that has stopped.
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    batch.append(item)
+
+            for (_, _, future) in batch:
+                if not future.done():
+                    future.set_exception(WriteBehindUnavailable())
+
+            # Connections are per thread; close the ones this thread opened.
+            for database in databases:
+                if not database.is_closed():
+                    database.close()
+
+    def transaction(self, database, writes, savepoints):
+        """[(future, result, error)] for writes, run in one transaction on database.
+
+        Without savepoints the first failing write rolls back the whole transaction and raises.
+        """
+        results = []
+        with database.atomic():
+            for (fn, future) in writes:
+                if not savepoints:
+                    results.append((future, fn(), None))
+                    continue
+
+                try:
+                    with database.atomic():
+                        results.append((future, fn(), None))
+                except Exception as e:
+                    results.append((future, None, e))
+        return results
+
+    def commit(self, batch):
+        by_database = OrderedDict()
+        for (database, fn, future) in batch:
+            # Skip writes whose caller timed out while they were queued.
+            if not future.set_running_or_notify_cancel():
+                continue
+            by_database.setdefault(database, []).append((fn, future))
+
+        for (database, writes) in by_database.items():
+            try:
+                try:
+                    results = self.transaction(database, writes, savepoints=False)
+                except Exception:
+                    # Redo the group with a savepoint per write, so only the writes that fail are rejected.
+                    results = self.transaction(database, writes, savepoints=True)
+            except Exception as e:
+                logging.exception('group commit failed: database=%s, writes=%d', database.database, len(writes))
+                for (fn, future) in writes:
+                    future.set_exception(e)
+                continue
+
+            self.groups += 1
+            logging.debug('group committed: database=%s, writes=%d', database.database, len(writes))
+
+            for (future, result, error) in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = SqliteDatabase(os.path.join(self.dir, 'messages.db'))
+        with Using(self.db, [Message], with_transaction=False):
+            Message.create_table()
+
+        self.write_behind = WriteBehind(max_rows=10, max_delay_ms=50)
+
+    def tearDown(self):
+        self.write_behind.stop()
+        if not self.db.is_closed():
+            self.db.close()
+        shutil.rmtree(self.dir)
+
+    def insert(self, subject):
+        return on(Message.insert(user=1, subject=subject), self.db).execute()
+
+    def count(self):
+        return on(Message.select(), self.db).count()
+
+    def test_group(self):
+        ids = []
+
+        def submit(i):
+            ids.append(self.write_behind.submit(self.db, lambda: self.insert(str(i))))
+
+        threads = [threading.Thread(target=submit, args=(i, )) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(ids)), 20)
+        self.assertEqual(self.count(), 20)
+        self.assertLess(self.write_behind.groups, 20)
+
+    def test_delay(self):
+        # A lone write is committed once max_delay_ms passes without the group filling up.
+        self.assertEqual(self.write_behind.submit(self.db, lambda: self.insert('a')), 1)
+        self.assertEqual(self.write_behind.groups, 1)
+
+    def test_failed_write(self):
+        def fail():
+            self.insert('rolled back')
+            raise IntegrityError('failed')
+
+        batch = [(self.db, fn, Future()) for fn in (lambda: self.insert('a'), fail, lambda: self.insert('b'))]
+        self.write_behind.commit(batch)
+
+        self.assertEqual(batch[0][2].result(), 1)
+        self.assertRaises(IntegrityError, batch[1][2].result)
+        self.assertEqual(batch[2][2].result(), 2)
+        self.assertEqual(self.write_behind.groups, 1)
+
+        query = on(Message.select(Message.subject).order_by(Message.id).tuples(), self.db)
+        self.assertEqual([s for (s, ) in query], ['a', 'b'])
+
+    def test_timeout(self):
+        self.write_behind.max_rows = 1
+        self.write_behind.timeout = 0.1
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def block():
+            blocked.set()
+            release.wait()
+            return self.insert('first')
+
+        thread = threading.Thread(target=self.write_behind.submit, args=(self.db, block))
+        thread.start()
+        blocked.wait()
+
+        # Queued behind the stalled group: the caller gets 503 and the write is dropped.
+        self.assertRaises(WriteBehindUnavailable, self.write_behind.submit, self.db, lambda: self.insert('second'))
+
+        release.set()
+        thread.join()
+        self.assertEqual(self.write_behind.submit(self.db, lambda: self.insert('third')), 2)
+        self.assertEqual(self.count(), 2)
+
+    def test_writer_died(self):
+        def fail(batch):
+            raise RuntimeError('writer bug')
+
+        self.write_behind.commit = fail
+        self.assertRaises(WriteBehindUnavailable, self.write_behind.submit, self.db, lambda: self.insert('a'))
+
+        # The next write starts a new writer.
+        del self.write_behind.commit
+        self.assertEqual(self.write_behind.submit(self.db, lambda: self.insert('b')), 1)
+
+    def test_disabled(self):
+        self.assertFalse(WriteBehind())
+        self.assertTrue(self.write_behind)
+
+if __name__ == '__main__':
+    unittest.main()